@@ -3,41 +3,807 @@
 # Bing Translator
 
 import os
+import bisect
 import codecs
+import collections
+import contextlib
+import contextvars
+import hashlib
 import json
+import queue
+import random
 import re
+import sqlite3
+import tempfile
+import threading
+import time
 import urllib
-import requests
-import lxml.html
-import markdown
-from markdown.inlinepatterns import Pattern
-from markdown.util import etree
-from markdown.extensions import Extension
+import urllib.parse
+import zlib
 import xml.etree.ElementTree as ET
 
 
-class BingTranslator:
+# Statistics
+
+_current_stats = contextvars.ContextVar('jupyter_translate_stats', default=None)
+
+
+class Stats:
+    """Timers and counters of a translation run. The active Stats object
+    is kept in a context variable, and everything recorded to it is also
+    recorded to its parent, so that a run can be reported per notebook and
+    in total.
+    """
+
+    def __init__(self, name=None, parent=None):
+        self.name = name
+        self.parent = parent
+        self.times = {}
+        self.counts = {}
+        self.children = []
+        self._lock = threading.Lock()
+        if parent is not None:
+            with parent._lock:
+                parent.children.append(self)
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.times[stage] = self.times.get(stage, 0.0) + seconds
+        if self.parent is not None:
+            self.parent.add_time(stage, seconds)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+        if self.parent is not None:
+            self.parent.count(name, n)
+
+    @contextlib.contextmanager
+    def activate(self):
+        token = _current_stats.set(self)
+        try:
+            yield self
+        finally:
+            _current_stats.reset(token)
+
+    def to_dict(self):
+        res = {'times': dict(self.times), 'counts': dict(self.counts)}
+        if self.name is not None:
+            res['name'] = self.name
+        if len(self.children) > 0:
+            res['children'] = [child.to_dict() for child in self.children]
+        return res
+
+    def report(self):
+        lines = ['%s:' % (self.name or 'Total',)]
+        for stage, seconds in sorted(self.times.items()):
+            lines.append('  %-20s %10.3f s' % (stage, seconds))
+        for name, n in sorted(self.counts.items()):
+            lines.append('  %-20s %10d' % (name, n))
+        batches = self.counts.get('batches', 0)
+        if batches > 0:
+            lines.append('  %-20s %10.1f %%' % (
+                'batch fill ratio', 100.0 * self.counts.get('batch_chars', 0) / self.counts.get('batch_capacity', 1)))
+        return '\n'.join(lines)
+
+
+@contextlib.contextmanager
+def stats_timer(stage):
+    stats = _current_stats.get()
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.add_time(stage, time.perf_counter() - start)
+
+
+def stats_count(name, n=1):
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.count(name, n)
+
+
+# Translation cache
+
+class TranslationCache:
+    """A persistent translation cache stored in an SQLite database in WAL
+    mode. Entries are keyed by a hash of the text and the translation
+    options, looked up on demand and committed as they are added, so that
+    every batch already translated survives an interrupted run.
+
+    `layers' are the file names of other caches, such as the shards of a
+    sharded run, which are read after this one but never written.
+    """
+
+    def __init__(self, fname, layers=()):
+        self.fname = fname
+        self._lock = threading.Lock()
+        self._layers = [
+            sqlite3.connect('file:%s?mode=ro' % (urllib.parse.quote(os.path.abspath(layer)),), uri=True, check_same_thread=False)
+            for layer in layers
+            ]
+        self._conn = sqlite3.connect(fname, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries '
+            '(key TEXT PRIMARY KEY, value TEXT, created REAL)')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(text, from_lang=None, to_lang=None, content_type=None, category=None):
+        data = json.dumps([text, from_lang, to_lang, content_type, category], ensure_ascii=False)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            for conn in [self._conn] + self._layers:
+                row = conn.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    return row[0]
+        return None
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def put_many(self, items):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO entries (key, value, created) VALUES (?, ?, ?)',
+                [(key, value, now) for key, value in items])
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def evict(self, max_entries=None, max_age=None):
+        """Remove entries older than `max_age' seconds and the oldest
+        entries beyond `max_entries'.
+        """
+        with self._lock:
+            if max_age is not None:
+                self._conn.execute('DELETE FROM entries WHERE created < ?', (time.time() - max_age,))
+            if max_entries is not None:
+                self._conn.execute(
+                    'DELETE FROM entries WHERE key NOT IN '
+                    '(SELECT key FROM entries ORDER BY created DESC LIMIT ?)', (max_entries,))
+            self._conn.commit()
+
+    def migrate_json(self, json_fname):
+        """Import a JSON cache written by older versions, which is keyed by
+        the urlencoded request parameters. The import is done only once.
+        """
+        name = 'migrated:' + os.path.abspath(json_fname)
+        with self._lock:
+            if self._conn.execute('SELECT 1 FROM meta WHERE name = ?', (name,)).fetchone() is not None:
+                return
+        with codecs.open(json_fname, 'r', 'utf-8-sig') as f:
+            cache = json.load(f)
+        items = []
+        for params, value in cache.items():
+            query = urllib.parse.parse_qs(params, keep_blank_values=True)
+            key = self.make_key(
+                query['text'][0], query['from'][0], query['to'][0],
+                query['contentType'][0], query['category'][0] if 'category' in query else None)
+            items.append((key, value))
+        self.put_many(items)
+        with self._lock:
+            self._conn.execute('INSERT INTO meta (name, value) VALUES (?, ?)', (name, str(len(items))))
+            self._conn.commit()
+
+    def merge(self, fname):
+        """Add the entries of another cache. Entries in both keep the most
+        recent value. Returns the number of entries read.
+        """
+        with self._lock:
+            self._conn.execute('ATTACH DATABASE ? AS shard', (fname,))
+            try:
+                n = self._conn.execute('SELECT COUNT(*) FROM shard.entries').fetchone()[0]
+                self._conn.execute(
+                    'INSERT INTO entries (key, value, created) '
+                    'SELECT key, value, created FROM shard.entries WHERE true '
+                    'ON CONFLICT (key) DO UPDATE SET value = excluded.value, created = excluded.created '
+                    'WHERE excluded.created > entries.created')
+                self._conn.commit()
+            finally:
+                self._conn.execute('DETACH DATABASE shard')
+        return n
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+            for conn in self._layers:
+                conn.close()
+
+
+# Translation memory
+
+class TranslationMemory:
+    """A translation memory of reviewed translations stored in an SQLite
+    database. Texts are indexed by MinHash signatures of their character
+    shingles split into bands (locality-sensitive hashing), so that texts
+    similar to a query are found by a few indexed lookups, and candidates
+    are ranked by the Jaccard similarity of their shingles. The signatures
+    use one permutation hashing: each shingle is hashed once into one of
+    the slots, and empty slots are filled from the next slot.
+
+    With `reuse', NotebookTranslator uses a match above `threshold' as an
+    unchecked translation instead of sending the text; otherwise the match
+    is attached to the translated cell as a suggestion.
+    """
+
+    shingle_size = 5
+    num_bands = 8
+    band_size = 4
+    max_candidates = 20
+
+    def __init__(self, fname, threshold=0.8, reuse=False):
+        self.fname = fname
+        self.threshold = threshold
+        self.reuse = reuse
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(fname, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS segments '
+            '(id INTEGER PRIMARY KEY, langs TEXT, source TEXT, target TEXT, UNIQUE (langs, source))')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS bands (band INTEGER, segment INTEGER)')
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS bands_band ON bands (band)')
+        self._conn.commit()
+
+    @classmethod
+    def _normalize(cls, text):
+        return ' '.join(text.lower().split())
+
+    @classmethod
+    def shingles(cls, text):
+        text = cls._normalize(text)
+        if len(text) <= cls.shingle_size:
+            return {text}
+        return {
+            text[i:i + cls.shingle_size]
+            for i in range(len(text) - cls.shingle_size + 1)
+            }
+
+    def signature(self, shingles):
+        size = self.num_bands * self.band_size
+        slots = [None] * size
+        for shingle in shingles:
+            h = (zlib.crc32(shingle.encode('utf-8')) * 0x9e3779b97f4a7c15) & 0xffffffffffffffff
+            i, value = h % size, h // size
+            if slots[i] is None or value < slots[i]:
+                slots[i] = value
+        signature = []
+        for i in range(size):
+            for distance in range(size):
+                value = slots[(i + distance) % size]
+                if value is not None:
+                    signature.append((distance, value))
+                    break
+        return signature
+
+    def _band_keys(self, langs, shingles):
+        signature = self.signature(shingles)
+        keys = []
+        for i in range(self.num_bands):
+            band = signature[i * self.band_size:(i + 1) * self.band_size]
+            data = json.dumps([langs, i, band]).encode('utf-8')
+            keys.append(int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little', signed=True))
+        return keys
+
+    @staticmethod
+    def similarity(a, b):
+        if len(a) == 0 and len(b) == 0:
+            return 1.0
+        return len(a & b) / len(a | b)
+
+    def add_many(self, items, from_lang='en', to_lang='ja'):
+        """Add (source, target) pairs. A pair replaces the previous
+        translation of the same source.
+        """
+        langs = '%s:%s' % (from_lang, to_lang)
+        rows = [
+            (source, target, self._band_keys(langs, self.shingles(source)))
+            for source, target in items
+            ]
+        with self._lock:
+            for source, target, keys in rows:
+                row = self._conn.execute(
+                    'SELECT id FROM segments WHERE langs = ? AND source = ?', (langs, source)).fetchone()
+                if row is not None:
+                    self._conn.execute('UPDATE segments SET target = ? WHERE id = ?', (target, row[0]))
+                    continue
+                segment = self._conn.execute(
+                    'INSERT INTO segments (langs, source, target) VALUES (?, ?, ?)',
+                    (langs, source, target)).lastrowid
+                self._conn.executemany(
+                    'INSERT INTO bands (band, segment) VALUES (?, ?)',
+                    [(key, segment) for key in keys])
+            self._conn.commit()
+
+    def lookup(self, text, from_lang='en', to_lang='ja'):
+        """Return (similarity, source, target) of the closest text whose
+        similarity is at least `threshold', or None.
+        """
+        langs = '%s:%s' % (from_lang, to_lang)
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT target FROM segments WHERE langs = ? AND source = ?', (langs, text)).fetchone()
+        if row is not None:
+            return 1.0, text, row[0]
+        shingles = self.shingles(text)
+        keys = self._band_keys(langs, shingles)
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT segment, COUNT(*) AS n FROM bands WHERE band IN (%s) '
+                'GROUP BY segment ORDER BY n DESC LIMIT ?' % ','.join('?' * len(keys)),
+                keys + [self.max_candidates]).fetchall()
+            candidates = [
+                self._conn.execute('SELECT source, target FROM segments WHERE id = ?', (segment,)).fetchone()
+                for segment, _ in rows
+                ]
+        best = None
+        for source, target in candidates:
+            similarity = self.similarity(shingles, self.shingles(source))
+            if similarity >= self.threshold and (best is None or similarity > best[0]):
+                best = (similarity, source, target)
+        return best
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM segments').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Request scheduler
+
+class TransientError(Exception):
+    """A request failed in a way that is worth retrying, such as throttling
+    or a server error. `retry_after' is the delay the service asked for, in
+    seconds, or None.
+    """
+
+    def __init__(self, message, retry_after=None, throttled=False):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+        self.throttled = throttled
+
+
+class RequestScheduler:
+    """Limits the requests in flight and the characters per request, and
+    adjusts both AIMD-style: they grow additively while requests succeed
+    and are halved when the service throttles. Transient failures are
+    retried with jittered exponential backoff, and all requests pause for
+    the time given by Retry-After.
+    """
+
+    def __init__(self, max_concurrency=4, max_chars=10240, min_chars=1024, max_retries=6, base_delay=1.0, max_delay=60.0):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_chars = max_chars
+        self.min_chars = min(min_chars, max_chars)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.concurrency = float(self.max_concurrency)
+        self.chars = max_chars
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                delay = self._paused_until - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                elif self._in_flight >= int(self.concurrency):
+                    self._cond.wait()
+                else:
+                    self._in_flight += 1
+                    return
+
+    def _release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def _on_success(self):
+        with self._cond:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1.0 / self.concurrency)
+            self.chars = min(self.max_chars, self.chars + self.max_chars // 16)
+            self._cond.notify_all()
+
+    def _on_failure(self, ex, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+        with self._cond:
+            if ex.throttled:
+                self.concurrency = max(1.0, self.concurrency / 2)
+                self.chars = max(self.min_chars, self.chars // 2)
+            if ex.retry_after is not None:
+                delay = max(delay, ex.retry_after)
+                self._paused_until = max(self._paused_until, time.time() + ex.retry_after)
+        return delay
+
+    def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            self._acquire()
+            try:
+                res = func(*args, **kwargs)
+            except TransientError as ex:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._on_failure(ex, attempt)
+                stats_count('retries')
+                if ex.throttled:
+                    stats_count('throttled')
+            else:
+                self._on_success()
+                return res
+            finally:
+                self._release()
+            time.sleep(delay)
+            attempt += 1
+
+
+def _parse_retry_after(value):
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        import email.utils
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# Translator backends
+
+_SPLIT_RES = [
+    re.compile(r'\n\n+'),
+    re.compile(r'\n'),
+    re.compile(r'(?<=[.!?\u3002])\s+'),
+    re.compile(r'\s+'),
+    ]
+
+
+_HTML_TAG_RE = re.compile(r'<(/?)([a-zA-Z][\w-]*)[^>]*>')
+_HTML_ELEMENT_RE = re.compile(r'(\s*<([a-zA-Z][\w-]*)[^>]*>)(.*)(</\2>\s*)$', re.S)
+_VOID_TAGS = set([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link',
+    'meta', 'source', 'track', 'wbr'
+    ])
+
+
+def _top_level_spans(html):
+    """Return the (start, end) spans of `html' outside elements."""
+    spans = []
+    depth = 0
+    start = 0
+    for m in _HTML_TAG_RE.finditer(html):
+        if depth == 0:
+            spans.append((start, m.start()))
+        if m.group(0).endswith('/>') or m.group(2).lower() in _VOID_TAGS:
+            pass
+        elif m.group(1):
+            depth = max(0, depth - 1)
+        else:
+            depth += 1
+        start = m.end()
+    if depth == 0:
+        spans.append((start, len(html)))
+    return spans
+
+
+def _strip_part(text):
+    # Whitespace around a part is kept out of the request, because
+    # services may trim it.
+    m = re.match(r'(\s*)(.*?)(\s*)$', text, re.S)
+    if m.group(2) == '':
+        return [text]
+    return [m.group(1), m.group(2), m.group(3)]
+
+
+def _join_pieces(*pieces_list):
+    """Concatenate lists of separators and parts made by split_text."""
+    res = ['']
+    for pieces in pieces_list:
+        if len(pieces) > 0:
+            res[-1] += pieces[0]
+            res.extend(pieces[1:])
+    return res
+
+
+class TranslatorBackend:
+    """Base class of translation backends. Subclasses implement translate
+    and translate_array, and set the limits of a single request.
+    translate_array_safe splits texts into requests within the limits,
+    sends them concurrently and caches the results. When `offline' is
+    set, no requests are sent and texts missing from the cache are
+    translated to None.
+    """
+
+    max_chars_per_request = 10240
+    max_texts_per_request = None
+    offline = False
+
+    def __init__(self, cache_fname='bing.cache.sqlite', legacy_cache_fname='bing.cache', max_concurrency=4, cache_layers=()):
+        self.cache_fname = cache_fname
+        self.legacy_cache_fname = legacy_cache_fname
+        self.cache_layers = cache_layers
+        self.cache = None
+        self.max_concurrency = max_concurrency
+        self.scheduler = RequestScheduler(max_concurrency, self.max_chars_per_request)
+        self.load_cache()
+
+    def load_cache(self):
+        with stats_timer('cache load'):
+            if self.cache is None:
+                self.cache = TranslationCache(self.cache_fname, self.cache_layers)
+            if self.legacy_cache_fname is not None and os.path.exists(self.legacy_cache_fname):
+                self.cache.migrate_json(self.legacy_cache_fname)
+
+    def save_cache(self):
+        # Entries are committed as they are added.
+        pass
+
+    def translate(self, text, content_type='text/html', from_lang='en', to_lang='ja'):
+        raise NotImplementedError()
+
+    def translate_array(self, text_list, **config):
+        raise NotImplementedError()
+
+    def text_size(self, text):
+        """Return the size a text takes in a request, which is compared with
+        `max_chars_per_request'.
+        """
+        return len(text)
+
+    def split_text(self, text, limit, html=False):
+        """Split a text whose size is over `limit' into parts at block, line,
+        sentence or word boundaries, so that the parts can be translated
+        separately. Returns a list whose odd items are the parts and whose
+        even items are the separators around them, which are not
+        translated, so that the text is the concatenation of the list.
+        With `html', the text is split only outside elements, and an
+        element too large for a request is split inside its tags, so that
+        each part is balanced HTML.
+        """
+        if self.text_size(text) <= limit:
+            return _strip_part(text)
+        spans = _top_level_spans(text) if html else [(0, len(text))]
+        boundaries = []
+        for pattern in _SPLIT_RES:
+            boundaries = [
+                (m.start(), m.end())
+                for start, end in spans
+                for m in pattern.finditer(text, start, end)
+                if 0 < m.start() < m.end() < len(text)
+                ]
+            if len(boundaries) > 0:
+                break
+        if len(boundaries) == 0:
+            m = _HTML_ELEMENT_RE.match(text) if html else None
+            if m is not None and spans == [(0, text.index('<')), (text.rindex('>') + 1, len(text))]:
+                return _join_pieces(
+                    [m.group(1)], self.split_text(m.group(3), limit, html), [m.group(4)])
+            if html:
+                # The text cannot be split without breaking its markup.
+                return _strip_part(text)
+            boundaries = [(len(text) // 2, len(text) // 2)]
+        pieces = []
+        chunk = text[:boundaries[0][0]]
+        for i, (start, end) in enumerate(boundaries):
+            separator = text[start:end]
+            piece = text[end:boundaries[i + 1][0] if i + 1 < len(boundaries) else len(text)]
+            if self.text_size(chunk + separator + piece) <= limit:
+                chunk += separator + piece
+            else:
+                pieces = _join_pieces(pieces, self.split_text(chunk, limit, html), [separator])
+                chunk = piece
+        return _join_pieces(pieces, self.split_text(chunk, limit, html))
+
+    def translate_array_safe(self, text_list, cancel=None, **config):
+        """Translate a list of texts through the cache. `cancel' is a
+        threading.Event which, when set by the caller, stops the batches
+        which are not sent yet.
+        """
+        def make_key(text):
+            return TranslationCache.make_key(
+                text, config.get('from_lang'), config.get('to_lang'),
+                config.get('content_type'), config.get('category'))
+
+        keys = [make_key(text) for text in text_list]
+        translations = {}
+        untranslated_list = []
+        with stats_timer('cache lookup'):
+            for key, text in zip(keys, text_list):
+                if key in translations:
+                    continue
+                translations[key] = self.cache.get(key)
+                if translations[key] is None:
+                    untranslated_list.append((key, text))
+        stats_count('cache hits', len(translations) - len(untranslated_list))
+        stats_count('cache misses', len(untranslated_list))
+        if self.offline:
+            return [translations[key] for key in keys]
+
+        # Texts too large for a request are translated in parts, which are
+        # cached on their own so that an interrupted run keeps them.
+        split_keys = {}
+        texts = {}
+        for key, text in untranslated_list:
+            if self.text_size(text) <= self.max_chars_per_request:
+                texts[key] = text
+                continue
+            pieces = self.split_text(text, self.max_chars_per_request, config.get('content_type') == 'text/html')
+            stats_count('split texts')
+            parts = pieces[1::2]
+            split_keys[key] = (pieces, [make_key(part) for part in parts])
+            for part_key, part in zip(split_keys[key][1], parts):
+                if part_key not in translations and part_key not in texts:
+                    value = self.cache.get(part_key)
+                    if value is None:
+                        texts[part_key] = part
+                    else:
+                        translations[part_key] = value
+
+        # Batches are packed first-fit decreasing: each batch takes the
+        # largest texts that still fit. They are packed as requests are
+        # sent, so that they shrink as soon as the scheduler lowers the
+        # characters per request.
+        pending = sorted((self.text_size(text), key) for key, text in texts.items())
+        lock = threading.Lock()
+        failed = []
+
+        def next_batch():
+            with lock:
+                if len(failed) > 0 or (cancel is not None and cancel.is_set()):
+                    return []
+                limit = self.scheduler.chars
+                batch = []
+                c = 0
+                while len(pending) > 0 and len(batch) != self.max_texts_per_request:
+                    i = bisect.bisect_left(pending, (limit - c + 1,)) - 1
+                    if i < 0:
+                        if len(batch) > 0:
+                            break
+                        i = len(pending) - 1
+                    size, key = pending.pop(i)
+                    batch.append((key, texts[key]))
+                    c += size
+            if len(batch) > 0:
+                stats_count('batches')
+                stats_count('batch_chars', c)
+                stats_count('batch_capacity', limit)
+            return batch
+
+        def translate_batches():
+            items = []
+            try:
+                while True:
+                    batch = next_batch()
+                    if len(batch) == 0:
+                        return items
+                    res = self.scheduler.call(self.translate_array, [text for _, text in batch], **config)
+                    batch_items = [(key, value) for (key, _), value in zip(batch, res)]
+                    with stats_timer('cache save'):
+                        self.cache.put_many(batch_items)
+                    items.extend(batch_items)
+            except Exception:
+                with lock:
+                    failed.append(True)
+                raise
+
+        workers = min(self.max_concurrency, len(pending))
+        if workers <= 1:
+            results = [translate_batches()]
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(contextvars.copy_context().run, translate_batches)
+                    for _ in range(workers)
+                    ]
+                try:
+                    results = [future.result() for future in futures]
+                except BaseException:
+                    # Stop the workers after their current batches, which
+                    # are saved to the cache, on errors and interrupts.
+                    with lock:
+                        failed.append(True)
+                    raise
+        if cancel is not None and cancel.is_set():
+            raise Exception('Translation cancelled.')
+        for items in results:
+            translations.update(items)
+        if len(split_keys) > 0:
+            joined_items = [
+                (key, ''.join(
+                    translations[part_keys[i // 2]] if i % 2 == 1 else piece
+                    for i, piece in enumerate(pieces)))
+                for key, (pieces, part_keys) in split_keys.items()
+                ]
+            self.cache.put_many(joined_items)
+            translations.update(joined_items)
+        return [translations[key] for key in keys]
+
+
+class BingTranslator(TranslatorBackend):
     """A class to translate plain texts or HTML texts from one language to
     another using Bing Translator API.
     """
 
-    def __init__(self, key, cache_fname='bing.cache'):
+    max_texts_per_request = 2000
+
+    def __init__(self, key, cache_fname='bing.cache.sqlite', legacy_cache_fname='bing.cache', max_concurrency=4, endpoint='https://api.microsofttranslator.com/V2/Http.svc', cache_layers=(), timeout=(10.0, 120.0)):
         self.bing_translator_key = key
-        self.cache_fname = cache_fname
-        self.cache = {}
-        self.load_cache()
+        self.endpoint = endpoint
+        # The (connect, read) timeouts of requests in seconds, after which
+        # they are retried.
+        self.timeout = timeout
+        self._session = None
+        self._session_lock = threading.Lock()
+        TranslatorBackend.__init__(self, cache_fname, legacy_cache_fname, max_concurrency, cache_layers)
+
+    def _get_session(self):
+        # requests is imported on the first request to keep startup fast.
+        with self._session_lock:
+            if self._session is None:
+                import requests
+                self._session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(10, self.max_concurrency))
+                self._session.mount('https://', adapter)
+                self._session.mount('http://', adapter)
+            return self._session
+
+    def text_size(self, text):
+        # Texts are sent as escaped XML elements.
+        escaped = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        return len(escaped) + len('<ns1:string></ns1:string>')
 
     def set_bing_translator_key(self, key):
         self.bing_translator_key = key
 
-    def load_cache(self):
-        if os.path.exists(self.cache_fname):
-            with codecs.open(self.cache_fname, 'r', 'utf-8-sig') as f:
-                self.cache = json.load(f)
-
-    def save_cache(self):
-        with codecs.open(self.cache_fname, 'w', 'utf-8-sig') as f:
-            json.dump(self.cache, f)
+    def _check_response(self, r):
+        if r.status_code == 429 or r.status_code >= 500:
+            raise TransientError(
+                'Translator returned status %d.' % (r.status_code,),
+                retry_after=_parse_retry_after(r.headers.get('Retry-After')),
+                throttled=r.status_code in (429, 503))
+        r.raise_for_status()
+
+    def _request(self, method, url, **kwargs):
+        import requests
+        if self.offline:
+            raise Exception('No requests are sent in offline mode.')
+        session = self._get_session()
+        stats_count('requests')
+        try:
+            with stats_timer('http'):
+                r = session.request(method, url, timeout=self.timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as ex:
+            raise TransientError(str(ex))
+        try:
+            self._check_response(r)
+            return ET.fromstring(r.text)
+        finally:
+            r.close()
 
     def translate(self, text, content_type='text/html', from_lang='en', to_lang='ja'):
         params = urllib.parse.urlencode({
@@ -46,45 +812,26 @@ class BingTranslator:
             'from': from_lang,
             'to': to_lang
         })
-        if params in self.cache:
-            return self.cache[params]
+        key = TranslationCache.make_key(text, from_lang, to_lang, content_type)
+        res = self.cache.get(key)
+        if res is not None or self.offline:
+            return res
 
         headers = {
             'Ocp-Apim-Subscription-Key': self.bing_translator_key,
             'Accept': 'application/xml'
             }
-        r = requests.get(
-            'https://api.microsofttranslator.com/V2/Http.svc/Translate?' + params,
-            headers=headers
-            )
-        try:
-            root = ET.fromstring(r.text)
-            res = root.text
-        finally:
-            r.close()
+        stats_count('chars sent', len(text))
+        root = self.scheduler.call(
+            self._request, 'GET', self.endpoint + '/Translate?' + params,
+            headers=headers)
+        res = root.text
 
-        self.cache[params] = res
-        return res
-
-    def translate_array_safe(self, text_list, **config):
-        req = []
-        res = []
-        c = 0
-        for text in text_list:
-            if c + len(text) > 10240:
-                if len(req) == 0:
-                    raise Exception('The text to translate is too long. %d characters.' % len(text))
-                res.extend(self.translate_array(req, **config))
-                req = []
-                c = 0
-            req.append(text)
-            c += len(text)
-        if len(req) > 0:
-            res.extend(self.translate_array(req, **config))
+        self.cache.put(key, res)
         return res
 
     def translate_array(self, text_list, **config):
-        url = 'https://api.microsofttranslator.com/V2/Http.svc/TranslateArray'
+        url = self.endpoint + '/TranslateArray'
         headers = {
             'Ocp-Apim-Subscription-Key': self.bing_translator_key,
             'Content-Type': 'application/xml'
@@ -92,12 +839,8 @@ class BingTranslator:
         root = ET.Element('TranslateArrayRequest')
         self._add_translate_request(root, text_list, **config)
         data = ET.tostring(root)
-        r = requests.post(url, headers=headers, data=data)
-        try:
-            r.raise_for_status()
-            root = ET.fromstring(r.text)
-        finally:
-            r.close()
+        stats_count('chars sent', sum(len(text) for text in text_list))
+        root = self._request('POST', url, headers=headers, data=data)
         nsmap = {
             's': 'http://schemas.datacontract.org/2004/07/Microsoft.MT.Web.Service.V2'
             }
@@ -110,7 +853,7 @@ class BingTranslator:
         return res
 
     def get_translations_array(self, text_list, from_lang='en', to_lang='ja', category=None, content_type='text/html', **config):
-        url = 'https://api.microsofttranslator.com/V2/Http.svc/GetTranslationsArray'
+        url = self.endpoint + '/GetTranslationsArray'
         headers = {
             'Ocp-Apim-Subscription-Key': self.bing_translator_key,
             'Content-Type': 'application/xml'
@@ -118,11 +861,7 @@ class BingTranslator:
         root = ET.Element('GetTranslationsArrayRequest')
         self._add_translate_request(root, text_list, from_lang, to_lang, category, content_type, max_translations=3)
         data = ET.tostring(root)
-        r = requests.post(url, headers=headers, data=data)
-        try:
-            root = ET.fromstring(r.text)
-        finally:
-            r.close()
+        root = self.scheduler.call(self._request, 'POST', url, headers=headers, data=data)
         nsmap = {
             's': 'http://schemas.datacontract.org/2004/07/Microsoft.MT.Web.Service.V2'
             }
@@ -159,171 +898,915 @@ class BingTranslator:
 
 # Markdown
 
-class InlineMathPattern(Pattern):
-    def handleMatch(self, m):
-        el = etree.Element('math')
-        el.set('class', 'notranslate')
-        el.text = m.group(2)
-        return el
+def _define_markdown_extensions():
+    """Define the classes extending Python-Markdown. Markdown is imported
+    on first use to keep startup fast, and the classes are looked up as
+    attributes of the module.
+    """
+    from markdown.inlinepatterns import Pattern
+    from markdown.util import etree
+    from markdown.extensions import Extension
+
+    class InlineMathPattern(Pattern):
+        def handleMatch(self, m):
+            el = etree.Element('math')
+            el.set('class', 'notranslate')
+            el.text = m.group(2)
+            return el
+
+    class MathExtension(Extension):
+        def extendMarkdown(self, md, md_globals):
+            inline_math = InlineMathPattern(r'\$([^$]+)\$')
+            md.inlinePatterns.add('inlinemath', inline_math, '>emphasis2')
+
+    globals().update(InlineMathPattern=InlineMathPattern, MathExtension=MathExtension)
+
+
+def __getattr__(name):
+    if name in ('InlineMathPattern', 'MathExtension'):
+        _define_markdown_extensions()
+        return globals()[name]
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+_FENCE_RE = re.compile(r'^ {0,3}(```|~~~)')
+_LIST_ITEM_RE = re.compile(r'^ {0,3}([-*+]|\d+[.)])\s')
+
+
+def iter_markdown_blocks(lines):
+    """Split Markdown source lines into block-level segments such as
+    paragraphs, headings, lists and code blocks. Blank lines separate
+    blocks, except inside fenced code. Indented blocks and list items
+    following a list stay with the previous block so that lists are
+    never split.
+    """
+    block = []
+    is_list = False
+    fence = None
+    pending = None
+    for line in lines:
+        if fence is not None:
+            block.append(line)
+            if line.lstrip().startswith(fence):
+                fence = None
+            continue
+        if line.strip() == '':
+            if len(block) > 0:
+                if pending is not None:
+                    yield pending
+                pending = ''.join(block).rstrip('\n')
+                block = []
+            continue
+        if len(block) == 0 and pending is not None:
+            if line[0] in ' \t' or (is_list and _LIST_ITEM_RE.match(line)):
+                block.append(pending + '\n\n')
+            else:
+                yield pending
+                is_list = False
+            pending = None
+        if len(block) == 0:
+            is_list = False
+        if _LIST_ITEM_RE.match(line):
+            is_list = True
+        m = _FENCE_RE.match(line)
+        if m:
+            fence = m.group(1)
+        block.append(line if line.endswith('\n') else line + '\n')
+    if len(block) > 0:
+        if pending is not None:
+            yield pending
+        pending = ''.join(block).rstrip('\n')
+    if pending is not None:
+        yield pending
+
+
+def split_markdown_blocks(text):
+    return list(iter_markdown_blocks(text.splitlines(True)))
 
 
-class MathExtension(Extension):
-    def extendMarkdown(self, md, md_globals):
-        inline_math = InlineMathPattern(r'\$([^$]+)\$')
-        md.inlinePatterns.add('inlinemath', inline_math, '>emphasis2')
+_REFERENCE_RE = re.compile(r'^ {0,3}\[([^\]]+)\]:[ \t]*\S+.*$', re.M)
+_REFERENCE_LABEL_RE = re.compile(r'\[([^\]]+)\]')
+
+
+def _reference_label(label):
+    return ' '.join(label.split()).lower()
+
+
+def is_reference_definitions(block):
+    """Return True for a block with only link reference definitions such
+    as `[guide]: http://example.com/guide'.
+    """
+    return _REFERENCE_RE.search(block) is not None and _REFERENCE_RE.sub('', block).strip() == ''
 
 
 # Unmarkdown
 
+_RAW_BLOCK_TAGS = set([
+    'address', 'article', 'aside', 'audio', 'canvas', 'center', 'details',
+    'dl', 'fieldset', 'figure', 'footer', 'form', 'header', 'iframe',
+    'nav', 'noscript', 'object', 'script', 'section', 'style', 'table',
+    'video'
+    ])
+
+
+_ESCAPE_RE = re.compile(r'(?P<url>https?://\S+)|[\\`*\[\]]|(?<![^\W_])_|_(?![^\W_])|<(?=[A-Za-z/!?])|&(?=#?\w+;)')
+_ESCAPE_ENTITIES = {'<': '&lt;', '&': '&amp;'}
+_ESCAPE_LINE_START_RE = re.compile(r'^([ ]*)(?:([#>]|[-+](?=\s))|(\d+)\.(?=\s))', re.M)
+
+
+def _escape_markdown(text, line_start=True):
+    """Escape the characters of a text node which Markdown would read as
+    markup. URLs and underscores within words are left as they are. Block
+    markers are escaped only at the start of lines, and at the start of
+    the text when `line_start' is set.
+    """
+    def escape(m):
+        if m.group('url') is not None:
+            return m.group(0)
+        return _ESCAPE_ENTITIES.get(m.group(0), '\\' + m.group(0))
+    text = _ESCAPE_RE.sub(escape, text)
+
+    def escape_line_start(m):
+        if m.start() == 0 and not line_start:
+            return m.group(0)
+        if m.group(3) is not None:
+            return '%s%s\\.' % (m.group(1), m.group(3))
+        return '%s\\%s' % (m.group(1), m.group(2))
+    return _ESCAPE_LINE_START_RE.sub(escape_line_start, text)
+
+
 class Unmarkdown:
+    """Converts HTML generated by markdown back into Markdown. Elements are
+    dispatched on their tags through a table, and the output is collected
+    in a list which is joined once at the end. Elements without Markdown
+    syntax are written as raw HTML, and text is escaped.
+    """
 
     def __init__(self):
+        self._handlers = {
+            'h1': self._heading,
+            'h2': self._heading,
+            'h3': self._heading,
+            'h4': self._heading,
+            'h5': self._heading,
+            'h6': self._heading,
+            'p': self._paragraph,
+            'div': self._paragraph,
+            'blockquote': self._blockquote,
+            'ul': self._list,
+            'ol': self._list,
+            'li': self._list_item,
+            'pre': self._pre,
+            'hr': self._horizontal_rule,
+            'br': self._line_break,
+            'strong': self._strong,
+            'b': self._strong,
+            'em': self._emphasis,
+            'i': self._emphasis,
+            'code': self._code,
+            'a': self._link,
+            'img': self._image,
+            'math': self._math,
+            }
         self.reset()
 
     def reset(self):
-        self.list_type = None
-
-    def new_block(self, s):
-        if len(s) >= 1 and s[-1] != '\n':
-            return s + '\n\n'
-        elif len(s) >= 2 and s[-2:] != '\n\n':
-            return s + '\n'
+        self._parts = []
+        self._tail = ''
+        self._lists = []
+
+    def _write(self, s):
+        if s:
+            self._parts.append(s)
+            self._tail = (self._tail + s)[-2:]
+
+    def _new_block(self):
+        if self._tail == '':
+            return
+        if self._tail[-1] != '\n':
+            self._write('\n\n')
+        elif len(self._tail) >= 2 and self._tail != '\n\n':
+            self._write('\n')
+
+    def _new_line(self):
+        if self._tail != '' and self._tail[-1] != '\n':
+            self._write('\n')
+
+    def _write_children(self, elem):
+        if elem.text is not None:
+            self._write(_escape_markdown(elem.text))
+        for child in elem:
+            self.unmarkdown_elem(child)
+            tail = child.tail
+            if tail is not None:
+                if child.tag == 'br' and tail.startswith('\n'):
+                    tail = tail[1:]
+                self._write(_escape_markdown(tail, child.tag == 'br'))
+
+    def _render_children(self, elem):
+        parts, tail = self._parts, self._tail
+        self._parts, self._tail = [], ''
+        try:
+            self._write_children(elem)
+            return ''.join(self._parts)
+        finally:
+            self._parts, self._tail = parts, tail
+
+    def _indent(self, text, prefix):
+        return '\n'.join([
+            prefix + line if line != '' else line
+            for line in text.split('\n')
+            ])
+
+    def _heading(self, elem):
+        self._new_block()
+        self._write('#' * int(elem.tag[1]) + ' ' + self._render_children(elem).strip())
+
+    def _paragraph(self, elem):
+        self._new_block()
+        self._write(self._render_children(elem).strip())
+
+    def _blockquote(self, elem):
+        self._new_block()
+        text = self._render_children(elem).strip()
+        self._write('\n'.join([
+            '> ' + line if line != '' else '>'
+            for line in text.split('\n')
+            ]))
+
+    def _list(self, elem):
+        parent = elem.getparent()
+        if parent is not None and parent.tag == 'li':
+            self._new_line()
         else:
-            return s
-
-    def unmarkdown_elem(self, elem, s):
-        if elem.tag == 'h1':
-            s = self.new_block(s)
-            s += '# %s' % (elem.text,)
-        elif elem.tag == 'h2':
-            s = self.new_block(s)
-            s += '## %s' % (elem.text,)
-        elif elem.tag == 'h3':
-            s = self.new_block(s)
-            s += '### %s' % (elem.text,)
-        elif elem.tag == 'h4':
-            s = self.new_block(s)
-            s += '#### %s' % (elem.text,)
-        elif elem.tag == 'p' or elem.tag == 'div':
-            s = self.new_block(s)
-            s += self.unmarkdown_elem_list(elem).strip()
-        elif elem.tag == 'blockquote':
-            s = self.new_block(s)
-            s += '>' + self.unmarkdown_elem_list(elem).strip()
-        elif elem.tag == 'ul':
-            self.list_type = '- '
-            s = self.new_block(s)
-            s += self.unmarkdown_elem_list(elem).strip()
-        elif elem.tag == 'ol':
-            self.list_type = 1
-            s = self.new_block(s)
-            s += self.unmarkdown_elem_list(elem).strip()
-        elif elem.tag == 'li':
-            s = self.new_block(s)
-            if type(self.list_type) == str:
-                s += self.list_type + self.unmarkdown_elem_list(elem).strip()
-            elif type(self.list_type) == int:
-                s += str(self.list_type) + '. ' + self.unmarkdown_elem_list(elem).strip()
-                self.list_type += 1
-        elif elem.tag == 'br':
-            s = self.new_block(s)
-        elif elem.tag == 'pre':
-            s = self.new_block(s)
-            t = self.unmarkdown_elem_list(elem)
-            s += '\n'.join(['    %s' % (x,) for x in t.split('\n')])
-        elif elem.tag == 'strong':
-            s += '**%s**' % (elem.text,)
-        elif elem.tag == 'em':
-            s += '*%s*' % (elem.text,)
-        elif elem.tag == 'b':
-            s += '**%s**' % (elem.text,)
-        elif elem.tag == 'a':
-            s += '[%s](%s)' % (elem.text, elem.attrib.get('href', ''))
-        elif elem.tag == 'code':
-            s += '`%s`' % (elem.text,)
-        elif elem.tag == 'img':
-            s += '![%s](%s)' % (elem.attrib['alt'], elem.attrib['src'])
-        elif elem.tag == 'math':
-            s += '$%s$' % (elem.text,)
+            self._new_block()
+        if elem.tag == 'ol':
+            self._lists.append(int(elem.get('start', '1')))
         else:
-            raise Exception('Unsupported element %s' % (elem.tag))
-        return s
+            self._lists.append(None)
+        try:
+            self._write(self._render_children(elem).strip())
+        finally:
+            self._lists.pop()
 
-    def unmarkdown_elem_list(self, elem):
-        s = ''
-        if elem.text is not None:
-            s += elem.text
-        for child in elem:
-            s = self.unmarkdown_elem(child, s)
-            if child.tail is not None:
-                s += child.tail
-        return s
+    def _list_item(self, elem):
+        if len(self._lists) > 0 and self._lists[-1] is not None:
+            marker = '%d. ' % (self._lists[-1],)
+            self._lists[-1] += 1
+        else:
+            marker = '- '
+        if any(child.tag == 'p' for child in elem):
+            self._new_block()
+        else:
+            self._new_line()
+        text = self._render_children(elem).strip()
+        self._write(marker + self._indent(text, '    ').lstrip(' '))
+
+    def _pre(self, elem):
+        self._new_block()
+        self._write(self._indent(elem.text_content().rstrip('\n'), '    '))
+
+    def _horizontal_rule(self, elem):
+        self._new_block()
+        self._write('---')
+
+    def _line_break(self, elem):
+        self._write('  \n')
+
+    def _strong(self, elem):
+        self._write('**')
+        self._write_children(elem)
+        self._write('**')
+
+    def _emphasis(self, elem):
+        self._write('*')
+        self._write_children(elem)
+        self._write('*')
+
+    def _code(self, elem):
+        text = elem.text_content()
+        fence = '`'
+        while fence in text:
+            fence += '`'
+        if text.startswith('`') or text.endswith('`'):
+            text = ' ' + text + ' '
+        self._write(fence + text + fence)
+
+    def _title(self, elem):
+        title = elem.get('title')
+        if title is None:
+            return ''
+        return ' "%s"' % (title.replace('"', '\\"'),)
+
+    def _link(self, elem):
+        self._write('[')
+        self._write_children(elem)
+        self._write('](%s%s)' % (elem.get('href', ''), self._title(elem)))
+
+    def _image(self, elem):
+        self._write('![%s](%s%s)' % (elem.get('alt', ''), elem.get('src', ''), self._title(elem)))
+
+    def _math(self, elem):
+        self._write('$%s$' % (elem.text_content(),))
+
+    def _raw(self, elem):
+        import lxml.html
+        if isinstance(elem.tag, str) and elem.tag in _RAW_BLOCK_TAGS:
+            self._new_block()
+        self._write(lxml.html.tostring(elem, encoding='unicode', with_tail=False))
+
+    def unmarkdown_elem(self, elem):
+        handler = self._handlers.get(elem.tag, self._raw)
+        handler(elem)
 
     def convert(self, html):
+        import lxml.html
+        if html.strip() == '':
+            # lxml cannot parse an empty document.
+            return ''
         elem = lxml.html.fromstring(html)
-        s = ''
-        return self.unmarkdown_elem(elem, s)
+        self.unmarkdown_elem(elem)
+        return ''.join(self._parts)
 
 
 # Markdown translator
 
+_MASK_RE = re.compile(r'''
+    ^[ ]{0,3}(?P<fence>```|~~~)[^\n]*\n.*?^[ ]{0,3}(?P=fence)[^\n]*$  # fenced code
+  | \$\$.+?\$\$                                        # display math
+  | \$(?:[^$\n]|\n(?![ \t]*\n))+\$                    # inline math
+  | (?P<ticks>`+)(?:[^\n]|\n(?![ \t]*\n))+?(?<!`)(?P=ticks)(?!`)  # inline code
+  | <!--.*?-->                                         # HTML comment
+  | <(?:img|br|hr|input|source|embed|wbr)\b[^>]*>       # void HTML element
+  | <m\b[^>]*>(?:</m>)?                                 # literal placeholder
+  | (?<!\S)(?<!\]:[ ])https?://[^\s<>\[\]]*[^\s<>\[\]().,;:!?'"]  # bare URL
+  ''', re.M | re.S | re.X | re.I)
+_MASK_LINK_RE = re.compile(r'(\]\(|\b(?:href|src)=")([^)"\s]+)')
+_UNMASK_RE = re.compile(r'<m i="(\d+)"\s*/?>(?:</m>)?|(?:(?<=\]\()|(?<=href=")|(?<=src="))jt:(\d+)')
+
+
 class MarkdownTranslator:
+    """Translates Markdown texts by converting them to HTML and back. With
+    `pool', a process pool made by make_conversion_pool, the conversions
+    of translate_array and translate_array_multi run in the pool in chunks
+    of `pool_chunk_size' texts.
+    """
 
-    def __init__(self, bing_translator):
+    def __init__(self, bing_translator, masking=True, pool=None):
+        import markdown
+        if 'MathExtension' not in globals():
+            _define_markdown_extensions()
         self._bing_translator = bing_translator
-        self._markdown = markdown.Markdown(extensions=[MathExtension()])
+        self._markdown = markdown.Markdown(extensions=[globals()['MathExtension']()])
         self._unmarkdown = Unmarkdown()
+        self.masking = masking
+        self.pool = pool
+        self.pool_chunk_size = 64
+        self.pipeline_chunk_chars = 1 << 16
+        self.pipeline_depth = 4
 
     def translate(self, text, **config):
+        text, spans = self.mask(text)
         html = self.markdown(text)
-        html = self._bing_translator.translate(text, content_type='text/html', **config)
+        html = self._bing_translator.translate(html, content_type='text/html', **config)
+        if html is None:
+            return None
         text = self.unmarkdown(html)
-        return text
+        return self.unmask(text, spans)
+
+    def mask(self, text):
+        """Replace spans which are not to be translated, such as math, code,
+        URLs, link targets and void HTML elements, with short placeholders.
+        Link targets are replaced with `jt:N', which is restored only as a
+        link target, and literal placeholders in the text are masked too.
+        Returns the masked text and the list of the original spans.
+        """
+        spans = []
+        if not self.masking:
+            return text, spans
+
+        def mask_span(m):
+            spans.append(m.group(0))
+            return '<m i="%d"></m>' % (len(spans) - 1,)
+
+        def mask_link(m):
+            spans.append(m.group(2))
+            return '%sjt:%d' % (m.group(1), len(spans) - 1)
+
+        text = _MASK_RE.sub(mask_span, text)
+        text = _MASK_LINK_RE.sub(mask_link, text)
+        return text, spans
+
+    def unmask(self, text, spans, html=False):
+        """Restore the spans replaced by `mask'. With `html', the text is
+        HTML, and the spans are restored as rendered HTML.
+        """
+        if len(spans) == 0:
+            return text
+
+        def restore(m):
+            i = int(m.group(1) or m.group(2))
+            if i >= len(spans):
+                # Not one of the placeholders.
+                return m.group(0)
+            span = spans[i]
+            if not html:
+                return span
+            if m.group(2) is not None:
+                # A link target in an attribute.
+                return span.replace('&', '&amp;').replace('"', '&quot;')
+            return self.render_span(span)
+        return _UNMASK_RE.sub(restore, text)
+
+    def render_span(self, span):
+        html = self.markdown(span)
+        if html.startswith('<p>') and html.endswith('</p>') and html.count('<p>') == 1:
+            html = html[len('<p>'):-len('</p>')].strip()
+        return html
 
     def is_html(self, text):
-        if '<' in text and '</' in text:
-            ol = len([1 for x in text if x == '<'])
-            if ol >= 3:
-                cl = len([1 for x in text if x == '>'])
-                if cl >= 3:
-                    if ol - cl <= 2 or cl - ol <= 2:
-                        return True
-        return False
+        return '</' in text and text.count('<') >= 3 and text.count('>') >= 3
 
     def translate_array(self, text_list, **config):
-        do_unmarkdown = [not self.is_html(text) for text in text_list]
-        html_list = [self.markdown(text) for text in text_list]
-        html_list = self._bing_translator.translate_array_safe(html_list, content_type='text/html', **config)
-        if False:
-            text_list = [self.unmarkdown(html) for html in html_list]
-        else:
-            for i in range(len(html_list)):
+        """Translate a list of texts in a pipeline. Distinct texts are
+        converted to HTML in chunks of about `pipeline_chunk_chars'
+        characters, and each chunk is sent while the next one is converted.
+        Translated chunks are converted back as they arrive, and at most
+        `pipeline_depth' chunks are in flight.
+        """
+        translated = {}
+        in_flight = collections.deque()
+        finishing = []
+
+        def finish_chunk():
+            texts, prepared_list, future = in_flight.popleft()
+            html_list = future.result()
+            if self.pool is not None:
+                finishing.append((texts, self._map_pool(_finish_texts, list(zip(html_list, prepared_list)), 'unmarkdown')))
+                return
+            for text, html, prepared in zip(texts, html_list, prepared_list):
                 try:
-                    if do_unmarkdown[i]:
-                        text_list[i] = self.unmarkdown(html_list[i])
-                    else:
-                        text_list[i] = html_list[i]
+                    translated[text] = self.finish(html, prepared)
                 except Exception as ex:
-                    print(text_list[i])
+                    print(text)
                     raise ex
+
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=self.pipeline_depth)
+        # The chunks are sent on other threads, which do not see an
+        # interrupt in this one.
+        cancel = threading.Event()
+        try:
+            texts = []
+            prepared_list = []
+            size = 0
+            distinct = list(dict.fromkeys(text_list))
+            if self.pool is not None:
+                prepared_iter = self._map_pool(_prepare_texts, distinct, 'markdown')
+            else:
+                prepared_iter = (self.prepare(text) for text in distinct)
+            for i, (text, prepared) in enumerate(zip(distinct, prepared_iter)):
+                texts.append(text)
+                prepared_list.append(prepared)
+                size += len(prepared[0])
+                if size < self.pipeline_chunk_chars and i + 1 < len(distinct):
+                    continue
+                future = executor.submit(
+                    contextvars.copy_context().run, self._bing_translator.translate_array_safe,
+                    [html for html, _, _ in prepared_list], content_type='text/html', cancel=cancel, **config)
+                in_flight.append((texts, prepared_list, future))
+                texts = []
+                prepared_list = []
+                size = 0
+                while len(in_flight) > 0 and (in_flight[0][2].done() or len(in_flight) >= self.pipeline_depth):
+                    finish_chunk()
+            while len(in_flight) > 0:
+                finish_chunk()
+            for texts, results in finishing:
+                translated.update(zip(texts, results))
+        finally:
+            cancel.set()
+            executor.shutdown(cancel_futures=True)
+        for i in range(len(text_list)):
+            text_list[i] = translated[text_list[i]]
         return text_list
 
+    def translate_array_multi(self, text_lists, **config):
+        """Translate a list of texts for each target language in the dict
+        `text_lists'. Each distinct text is converted to HTML once, and the
+        languages are sent concurrently. Returns a dict from the languages
+        to the lists of the translated texts.
+        """
+        distinct = list(dict.fromkeys(text for text_list in text_lists.values() for text in text_list))
+        if self.pool is not None:
+            prepared = dict(zip(distinct, self._map_pool(_prepare_texts, distinct, 'markdown')))
+        else:
+            prepared = {text: self.prepare(text) for text in distinct}
+
+        cancel = threading.Event()
+
+        def translate(to_lang):
+            return self._bing_translator.translate_array_safe(
+                [prepared[text][0] for text in text_lists[to_lang]],
+                content_type='text/html', to_lang=to_lang, cancel=cancel, **config)
+
+        to_langs = [to_lang for to_lang in text_lists if len(text_lists[to_lang]) > 0]
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=max(1, len(to_langs)))
+        try:
+            futures = [
+                executor.submit(contextvars.copy_context().run, translate, to_lang)
+                for to_lang in to_langs
+                ]
+            html_lists = dict(zip(to_langs, [future.result() for future in futures]))
+        finally:
+            cancel.set()
+            executor.shutdown(cancel_futures=True)
+        if self.pool is not None:
+            return {
+                to_lang: list(self._map_pool(
+                    _finish_texts,
+                    [(html, prepared[text]) for text, html in zip(text_lists[to_lang], html_lists.get(to_lang, []))],
+                    'unmarkdown'))
+                for to_lang in text_lists
+                }
+        return {
+            to_lang: [
+                self.finish(html, prepared[text])
+                for text, html in zip(text_lists[to_lang], html_lists.get(to_lang, []))
+                ]
+            for to_lang in text_lists
+            }
+
+    def _map_pool(self, func, items, stage):
+        """Apply `func' to the items in chunks in the process pool. All the
+        chunks are submitted at once, and the results are returned by an
+        iterator in order. The time spent in the workers is added to
+        `stage'.
+        """
+        size = self.pool_chunk_size
+        results = self.pool.map(func, [items[i:i + size] for i in range(0, len(items), size)])
+        stats = _current_stats.get()
+
+        def iterate():
+            for chunk_results, seconds in results:
+                if stats is not None:
+                    stats.add_time(stage, seconds)
+                yield from chunk_results
+        return iterate()
+
+    def prepare(self, text):
+        """Mask and convert a text to HTML. Returns a tuple to pass to
+        `finish' with the translated HTML.
+        """
+        masked_text, spans = self.mask(text)
+        return self.markdown(masked_text), spans, not self.is_html(text)
+
+    def finish(self, html, prepared):
+        if html is None:
+            # Missing from the cache in offline mode.
+            return None
+        _, spans, do_unmarkdown = prepared
+        if do_unmarkdown:
+            return self.unmask(self.unmarkdown(html), spans)
+        return self.unmask(html, spans, html=True)
+
     def markdown(self, text):
-        self._markdown.reset()
-        return self._markdown.convert(text)
+        with stats_timer('markdown'):
+            self._markdown.reset()
+            return self._markdown.convert(text)
 
     def unmarkdown(self, text):
-        self._unmarkdown.reset()
-        return self._unmarkdown.convert(text)
+        with stats_timer('unmarkdown'):
+            self._unmarkdown.reset()
+            return self._unmarkdown.convert(text)
+
+
+# The converters of each worker process of a conversion pool.
+_worker_translator = None
+
+
+def _init_conversion_worker(masking):
+    global _worker_translator
+    _worker_translator = MarkdownTranslator(None, masking=masking)
+
+
+def _prepare_texts(texts):
+    start = time.perf_counter()
+    res = [_worker_translator.prepare(text) for text in texts]
+    return res, time.perf_counter() - start
+
+
+def _finish_texts(items):
+    start = time.perf_counter()
+    res = [_worker_translator.finish(html, prepared) for html, prepared in items]
+    return res, time.perf_counter() - start
+
+
+def make_conversion_pool(processes, masking=True):
+    """Return a process pool for MarkdownTranslator in which each worker
+    has its own converters.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(processes, initializer=_init_conversion_worker, initargs=(masking,))
+
+
+# Skip classifier
+
+_NON_PROSE_RE = re.compile(r'''
+    !\[[^\]]*\]\([^)]*\)      # image
+  | \[[^\]\s]*\]\([^)]*\)     # link labelled with a single word
+  | <[^>]*>                   # HTML tag
+  | https?://\S+              # bare URL
+  | ^[ ]{0,3}\[[^\]]+\]:.*$    # link reference definition
+  ''', re.M | re.X)
+_LETTER_RE = re.compile(r'[^\W\d_]')
+_SCRIPT_RES = {
+    'ja': re.compile(r'[\u3040-\u30ff\u4e00-\u9fff]'),
+    'zh': re.compile(r'[\u4e00-\u9fff]'),
+    'ko': re.compile(r'[\u1100-\u11ff\uac00-\ud7af]'),
+    'ru': re.compile(r'[\u0400-\u04ff]'),
+    'uk': re.compile(r'[\u0400-\u04ff]'),
+    'bg': re.compile(r'[\u0400-\u04ff]'),
+    'el': re.compile(r'[\u0370-\u03ff]'),
+    'he': re.compile(r'[\u0590-\u05ff]'),
+    'ar': re.compile(r'[\u0600-\u06ff]'),
+    'fa': re.compile(r'[\u0600-\u06ff]'),
+    'hi': re.compile(r'[\u0900-\u097f]'),
+    'th': re.compile(r'[\u0e00-\u0e7f]'),
+    }
+
+
+def needs_translation(text, from_lang='en', to_lang='ja'):
+    """Return False for texts which have no prose, such as cells with only
+    images, math, code or links, and for texts already written in the
+    script of `to_lang'. Only local character checks are made.
+    """
+    text = _MASK_RE.sub(' ', text)
+    text = _NON_PROSE_RE.sub(' ', text)
+    letters = len(_LETTER_RE.findall(text))
+    if letters == 0:
+        return False
+    to_re = _SCRIPT_RES.get(to_lang.split('-')[0].lower())
+    from_re = _SCRIPT_RES.get(from_lang.split('-')[0].lower())
+    if to_re is None:
+        return True
+    if len(to_re.findall(text)) * 2 < letters:
+        return True
+    return from_re is not None and len(from_re.findall(text)) * 2 >= letters
+
+
+# Atomic writes
+
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+@contextlib.contextmanager
+def atomic_open(fname):
+    """Open a temporary file next to `fname' for writing and rename it to
+    `fname' when the block exits normally, so that an interrupted run
+    leaves either the old file or the new one but never a truncated file.
+    """
+    fd, tmpfname = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(fname)),
+        prefix='.%s.' % (os.path.basename(fname),), suffix='.tmp')
+    try:
+        os.chmod(tmpfname, 0o666 & ~_umask)
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpfname, fname)
+    except BaseException:
+        if os.path.exists(tmpfname):
+            os.remove(tmpfname)
+        raise
+
+
+# Notebook streaming
+
+_JSON_WHITESPACE_RE = re.compile(r'\s*')
+_JSON_TOKEN_RE = re.compile(r'["{}\[\]]')
+_JSON_STRING_RE = re.compile(r'["\\]')
+_JSON_SCALAR_RE = re.compile(r'[^\s,\]}]+')
+
+
+class NotebookStream:
+    """Reads a notebook incrementally. Only markdown cells are parsed into
+    Python objects. Other cells and top-level values are skipped, or copied
+    as raw text to the output, so that large outputs are never held in
+    memory.
+    """
+
+    def __init__(self, f, chunk_size=1 << 16):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._buf = ''
+        self._pos = 0
+        self._sink = None
+
+    def _fill(self):
+        self._buf = self._buf[self._pos:]
+        self._pos = 0
+        data = self._f.read(self._chunk_size)
+        if not data:
+            return False
+        self._buf += data
+        return True
+
+    def _consume(self, end):
+        if self._sink is not None:
+            self._sink(self._buf[self._pos:end])
+        self._pos = end
+
+    def _peek(self):
+        while True:
+            self._consume(_JSON_WHITESPACE_RE.match(self._buf, self._pos).end())
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, c):
+        if self._peek() != c:
+            raise ValueError('Expected %s in notebook' % (c,))
+        self._consume(self._pos + 1)
+
+    def _skip_value(self):
+        c = self._peek()
+        if c not in '{["':
+            while True:
+                m = _JSON_SCALAR_RE.match(self._buf, self._pos)
+                if m is not None and m.end() < len(self._buf):
+                    self._consume(m.end())
+                    return
+                if not self._fill():
+                    if m is None:
+                        raise ValueError('Unexpected end of notebook')
+                    self._consume(m.end())
+                    return
+        depth = 0
+        in_string = False
+        while True:
+            if in_string:
+                m = _JSON_STRING_RE.search(self._buf, self._pos)
+                if m is None or (m.group() == '\\' and m.end() == len(self._buf)):
+                    self._consume(len(self._buf) if m is None else m.start())
+                    if not self._fill():
+                        raise ValueError('Unexpected end of notebook')
+                elif m.group() == '\\':
+                    self._consume(m.end() + 1)
+                else:
+                    self._consume(m.end())
+                    in_string = False
+                    if depth == 0:
+                        return
+            else:
+                m = _JSON_TOKEN_RE.search(self._buf, self._pos)
+                if m is None:
+                    self._consume(len(self._buf))
+                    if not self._fill():
+                        raise ValueError('Unexpected end of notebook')
+                    continue
+                self._consume(m.end())
+                c = m.group()
+                if c == '"':
+                    in_string = True
+                elif c in '{[':
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        return
+
+    def _read_value(self):
+        self._peek()
+        parts = []
+        sink = self._sink
+
+        def tee(s):
+            parts.append(s)
+            if sink is not None:
+                sink(s)
+
+        self._sink = tee
+        try:
+            self._skip_value()
+        finally:
+            self._sink = sink
+        return ''.join(parts)
+
+    def _iter_keys(self):
+        self._expect('{')
+        while True:
+            c = self._peek()
+            if c == '}':
+                self._consume(self._pos + 1)
+                return
+            if c == ',':
+                self._consume(self._pos + 1)
+            key = json.loads(self._read_value())
+            self._expect(':')
+            yield key
+
+    def _iter_array(self):
+        self._expect('[')
+        while True:
+            c = self._peek()
+            if c == ']':
+                self._consume(self._pos + 1)
+                return
+            if c == ',':
+                self._consume(self._pos + 1)
+                continue
+            yield
+
+    def _read_cell(self, write):
+        """Read a cell and return it if it is a markdown cell. Otherwise the
+        raw text of the cell is passed to `write' and None is returned.
+        """
+        self._peek()
+        parts = []
+        self._sink = parts.append
+        cell_type = None
+        for key in self._iter_keys():
+            if key == 'cell_type':
+                cell_type = json.loads(self._read_value())
+                if cell_type != 'markdown':
+                    if write is not None:
+                        write(''.join(parts))
+                    parts = None
+                    self._sink = write
+            else:
+                self._skip_value()
+        self._sink = None
+        if cell_type == 'markdown':
+            return json.loads(''.join(parts))
+        return None
+
+    def iter_markdown_cells(self):
+        for key in self._iter_keys():
+            if key != 'cells':
+                self._skip_value()
+                continue
+            for _ in self._iter_array():
+                cell = self._read_cell(None)
+                if cell is not None:
+                    yield cell
+
+    def copy(self, write, translate_cell):
+        """Copy the notebook to `write' in the format of json.dump with
+        indent=1, replacing each markdown cell with the list of cells
+        returned by `translate_cell'. Other values are copied as they are.
+        """
+        write('{')
+        sep = '\n '
+        for key in self._iter_keys():
+            write('%s%s: ' % (sep, json.dumps(key, ensure_ascii=False)))
+            sep = ',\n '
+            if key != 'cells':
+                self._peek()
+                self._sink = write
+                self._skip_value()
+                self._sink = None
+                continue
+            write('[')
+            cell_sep = '\n  '
+            for _ in self._iter_array():
+                write(cell_sep)
+                cell_sep = ',\n  '
+                cell = self._read_cell(write)
+                if cell is not None:
+                    write(cell_sep.join([
+                        json.dumps(x, indent=1, ensure_ascii=False, sort_keys=True).replace('\n', '\n  ')
+                        for x in translate_cell(cell)
+                        ]))
+            write(']' if cell_sep == '\n  ' else '\n ]')
+        write('\n}')
 
 
 # Jupyter notebook translator
 
+class CacheMissError(Exception):
+    """Raised in offline mode when texts to translate are missing from the
+    cache. `missing' is a dict from file names to the missing texts.
+    """
+
+    def __init__(self, missing):
+        Exception.__init__(self, '%d cells missing from the cache' % (sum(len(texts) for texts in missing.values()),))
+        self.missing = missing
+
+
 class NotebookTranslator:
 
-    def __init__(self, bing_translator):
-        self.markdown_translator = MarkdownTranslator(bing_translator)
+    def __init__(self, bing_translator, stream=False, memory=None, pool=None):
+        self.markdown_translator = MarkdownTranslator(bing_translator, pool=pool)
         self.translation_prefix = '_unchecked_'
+        self.stream = stream
+        self.translation_memory = memory
+        self.markdown_chunk_chars = 1 << 18
+        self.skip_untranslatable = True
 
     def translate_file(self, infname, outfname=None, output_dir=None, **config):
         if infname.endswith('.ipynb'):
@@ -331,7 +1814,8 @@ class NotebookTranslator:
         elif infname.endswith('.md'):
             self.translate_file_markdown(infname, outfname, output_dir, **config)
 
-    def _make_outfname(self, infname, outfname, output_dir, to_lang, ext):
+    @staticmethod
+    def _make_outfname(infname, outfname, output_dir, to_lang, ext):
         if outfname is None:
             outfname = re.sub(r'\.%s' % (ext,), '_%s.%s' % (to_lang, ext), infname)
             if infname == outfname:
@@ -340,27 +1824,189 @@ class NotebookTranslator:
                 outfname = os.path.join(output_dir, os.path.basename(outfname))
         return outfname
 
-    def translate_file_notebook(self, infname, outfname=None, output_dir=None, to_lang='ja', allow_update=False, allow_overwrite=False, **config):
-        outfname = self._make_outfname(infname, outfname, output_dir, to_lang, 'ipynb')
-        translation_dict = None
+    def translate_file_notebook(self, infname, outfname=None, output_dir=None, to_lang='ja', allow_update=False, allow_overwrite=False, replace=False, **config):
+        """Translate a notebook to a language, or to each language in the
+        list `to_lang'. The notebook is read and converted once for all the
+        languages.
+        """
+        if isinstance(to_lang, str):
+            to_langs, outfnames = [to_lang], [outfname]
+        else:
+            to_langs, outfnames = list(to_lang), outfname or [None] * len(to_lang)
+        doc = self._load_notebook(infname)
+        jobs = []
+        for lang, outfname in zip(to_langs, outfnames):
+            outfname = self._make_outfname(infname, outfname, output_dir, lang, 'ipynb')
+            translation_dict, segment_dict = self._get_previous_translations(
+                outfname, allow_update, allow_overwrite, config.get('from_lang', 'en'), lang)
+            plans = self.plan_document(doc, translation_dict, segment_dict, config.get('from_lang', 'en'), lang)
+            jobs.append((lang, outfname, plans))
+        if len(jobs) == 1:
+            lang, _, plans = jobs[0]
+            translations = {lang: self.translate_texts(self.get_untranslated_texts(plans), to_lang=lang, **config)}
+        else:
+            translations = self.translate_texts_multi(
+                {lang: self.get_untranslated_texts(plans) for lang, _, plans in jobs}, **config)
+        missing = list(dict.fromkeys(
+            text
+            for lang, _, plans in jobs
+            for text in self.get_missing_texts(plans, translations[lang])))
+        if len(missing) > 0:
+            raise CacheMissError({infname: missing})
+        for lang, outfname, plans in jobs:
+            # apply_document replaces doc['cells'] without changing the cells,
+            # so a shallow copy of the document is enough for each language.
+            self._write_notebook(
+                infname, outfname, plans, translations[lang], replace, dict(doc),
+                (config.get('from_lang', 'en'), lang))
+
+    def translate_corpus(self, fnames, outfnames=None, output_dir=None, to_lang='ja', allow_update=False, allow_overwrite=False, replace=False, **config):
+        """Translate notebooks together so that a text appearing in many of
+        them is converted and sent only once. The notebooks are read twice
+        to keep only one of them in memory at a time.
+        """
+        if outfnames is None:
+            outfnames = [None] * len(fnames)
+        jobs = []
+        for infname, outfname in zip(fnames, outfnames):
+            outfname = self._make_outfname(infname, outfname, output_dir, to_lang, 'ipynb')
+            translation_dict, segment_dict = self._get_previous_translations(
+                outfname, allow_update, allow_overwrite, config.get('from_lang', 'en'), to_lang)
+            doc = self._load_notebook(infname)
+            plans = self.plan_document(doc, translation_dict, segment_dict, config.get('from_lang', 'en'), to_lang)
+            jobs.append((infname, outfname, plans))
+        translations = self.translate_texts(
+            self.get_untranslated_texts([plan for _, _, plans in jobs for plan in plans]),
+            to_lang=to_lang, **config)
+        missing = {}
+        for infname, outfname, plans in jobs:
+            missing_texts = self.get_missing_texts(plans, translations)
+            if len(missing_texts) > 0:
+                missing[infname] = missing_texts
+                continue
+            print('Writing %s...' % (outfname,))
+            self._write_notebook(
+                infname, outfname, plans, translations, replace,
+                langs=(config.get('from_lang', 'en'), to_lang))
+        if len(missing) > 0:
+            raise CacheMissError(missing)
+
+    def _get_previous_translations(self, outfname, allow_update, allow_overwrite, from_lang='en', to_lang='ja'):
         if os.path.exists(outfname):
             if allow_update:
-                translation_dict = self.get_translations_from_file(outfname)
+                old_doc = self._load_notebook(outfname)
+                translation_dict = self.get_translations_from_doc(old_doc)
+                segment_dict = self.get_segment_translations_from_doc(old_doc)
+                if self.translation_memory is not None:
+                    self.add_to_memory(translation_dict, segment_dict, from_lang, to_lang)
+                return translation_dict, segment_dict
             elif not allow_overwrite:
                 raise Exception("Cannot overwrite file `%s'" % outfname)
-        with codecs.open(infname, 'r', 'utf-8-sig') as f:
-            doc = json.load(f)
-        self.translate_document(doc, to_lang=to_lang, translation_dict=translation_dict, **config)
-        with codecs.open(outfname, 'w', 'utf-8') as f:
+        return None, None
+
+    def _load_notebook(self, fname):
+        """Load a notebook. In stream mode only its markdown cells are
+        loaded.
+        """
+        with stats_timer('json load'), codecs.open(fname, 'r', 'utf-8-sig') as f:
+            if self.stream:
+                return {'cells': list(NotebookStream(f).iter_markdown_cells())}
+            return json.load(f)
+
+    def _write_notebook(self, infname, outfname, plans, translations, replace, doc=None, langs=None):
+        if self.stream:
+            translated_list = iter([self.apply_plan(plan, translations) for plan in plans])
+            with stats_timer('json dump'), codecs.open(infname, 'r', 'utf-8-sig') as f, atomic_open(outfname) as outf:
+                NotebookStream(f).copy(
+                    outf.write,
+                    lambda cell: self.translate_cell(cell, next(translated_list), replace, langs))
+            return
+        if doc is None:
+            doc = self._load_notebook(infname)
+        self.apply_document(doc, plans, translations, replace, langs)
+        with stats_timer('json dump'), atomic_open(outfname) as f:
             json.dump(doc, f, indent=1, ensure_ascii=False, sort_keys=True)
 
-    def translate_file_markdown(self, infname, outfname=None, output_dir=None, to_lang='ja', **config):
+    def translate_file_markdown(self, infname, outfname=None, output_dir=None, to_lang='ja', allow_update=False, allow_overwrite=False, replace=False, **config):
+        """Translate a Markdown file block by block. The blocks are read,
+        translated in batches and written in chunks of about
+        `markdown_chunk_chars' characters, so that memory use does not grow
+        with the size of the file. Link reference definitions are collected
+        first and added to the blocks using them, and are written as is.
+        """
+        if not isinstance(to_lang, str):
+            for lang in to_lang:
+                self.translate_file_markdown(infname, None, output_dir, lang, allow_update, allow_overwrite, replace, **config)
+            return
         outfname = self._make_outfname(infname, outfname, output_dir, to_lang, 'md')
+        if os.path.exists(outfname) and not allow_overwrite:
+            # Translated Markdown files keep no original text to update
+            # from, so updating would discard reviewed translations.
+            if allow_update:
+                raise Exception("Cannot update Markdown file `%s'. Use --overwrite to translate it again." % outfname)
+            raise Exception("Cannot overwrite file `%s'" % outfname)
+        references = {}
         with codecs.open(infname, 'r', 'utf-8-sig') as f:
-            text = f.read()
-        text = self.markdown_translator.translate(text, to_lang=to_lang, **config)
-        with codecs.open(outfname, 'w', 'utf-8') as f:
-            f.write(text)
+            for block in iter_markdown_blocks(f):
+                if _FENCE_RE.match(block) or block[0] in ' \t':
+                    continue
+                for m in _REFERENCE_RE.finditer(block):
+                    references.setdefault(_reference_label(m.group(1)), m.group(0))
+        missing = []
+        with codecs.open(infname, 'r', 'utf-8-sig') as f, atomic_open(outfname) as outf:
+            chunk = []
+            size = 0
+            separator = ''
+            for block in iter_markdown_blocks(f):
+                chunk.append(block)
+                size += len(block)
+                if size >= self.markdown_chunk_chars:
+                    for translated_block in self._translate_markdown_blocks(chunk, to_lang, missing, references, **config):
+                        outf.write(separator + translated_block)
+                        separator = '\n\n'
+                    chunk = []
+                    size = 0
+            for translated_block in self._translate_markdown_blocks(chunk, to_lang, missing, references, **config):
+                outf.write(separator + translated_block)
+                separator = '\n\n'
+            outf.write('\n')
+            if len(missing) > 0:
+                # The output is not renamed into place.
+                raise CacheMissError({infname: missing})
+
+    def _translate_markdown_blocks(self, blocks, to_lang, missing, references, **config):
+        def add_references(block):
+            # Markdown is converted block by block, so the definitions of
+            # the references in the block are added to it.
+            defined = set(_reference_label(label) for label in _REFERENCE_RE.findall(block))
+            used = [
+                references[label]
+                for label in dict.fromkeys(_reference_label(label) for label in _REFERENCE_LABEL_RE.findall(block))
+                if label in references and label not in defined
+                ]
+            if len(used) == 0:
+                return block
+            return block + '\n\n' + '\n'.join(used)
+
+        def plan(block):
+            if is_reference_definitions(block):
+                return None
+            if self.skip_untranslatable and not needs_translation(block, config.get('from_lang', 'en'), to_lang):
+                return None
+            return self.plan_translation(add_references(block), None, None, config.get('from_lang', 'en'), to_lang)
+
+        plans = [plan(block) for block in blocks]
+        translations = self.translate_texts(self.get_untranslated_texts(plans), to_lang=to_lang, **config)
+        missing_texts = self.get_missing_texts(plans, translations)
+        if len(missing_texts) > 0:
+            missing.extend(missing_texts)
+            return []
+        return [
+            block if plan is None else ''.join(
+                translated_text if translated_text is not None else translations[text]
+                for text, translated_text, _ in plan)
+            for block, plan in zip(blocks, plans)
+            ]
 
     def cell_to_markdown(self, cell, ensure_str=True):
         source = cell['source']
@@ -398,48 +2044,148 @@ class NotebookTranslator:
         else:
             raise RuntimeError('Unexpected')
 
-    def translate_document(self, doc, replace=False, translation_dict=None, **config):
-        if translation_dict is None:
-            translation_dict = {}
-        translation_list = [
-            self.cell_to_markdown(cell)
-            for cell in doc['cells']
-            if cell['cell_type'] == 'markdown'
-            ]
-        translation_list = [
-            (text, translation_dict.get(text))
-            for text in translation_list
-            ]
-        untranslated_text = [
-            text
-            for text, translated_text in translation_list
-            if translated_text is None
+    def translate_document(self, doc, replace=False, translation_dict=None, segment_dict=None, **config):
+        langs = (config.get('from_lang', 'en'), config.get('to_lang', 'ja'))
+        plans = self.plan_document(doc, translation_dict, segment_dict, *langs)
+        translations = self.translate_texts(self.get_untranslated_texts(plans), **config)
+        self.apply_document(doc, plans, translations, replace, langs)
+
+    def plan_document(self, doc, translation_dict=None, segment_dict=None, from_lang='en', to_lang='ja'):
+        """Plan the translation of the markdown cells. The plan of a cell is
+        None when it needs no translation and is copied as it is. Cells with
+        previous translations are never skipped, so that reviewed
+        translations are kept.
+        """
+        plans = []
+        for cell in doc['cells']:
+            if cell['cell_type'] == 'markdown':
+                text = self.cell_to_markdown(cell)
+                if self.skip_untranslatable and not self._has_translation(text, translation_dict, segment_dict) and not needs_translation(text, from_lang, to_lang):
+                    plans.append(None)
+                else:
+                    plans.append(self.plan_translation(text, translation_dict, segment_dict, from_lang, to_lang))
+        return plans
+
+    def _has_translation(self, text, translation_dict, segment_dict):
+        if translation_dict is not None and text in translation_dict:
+            return True
+        return bool(segment_dict) and any(segment in segment_dict for segment in split_markdown_blocks(text))
+
+    def apply_document(self, doc, plans, translations, replace=False, langs=None):
+        translated_list = [
+            self.apply_plan(plan, translations)
+            for plan in plans
             ]
-        if len(untranslated_text) == 0:
-            translated_text_list = []
-        else:
-            translated_text_list = self.markdown_translator.translate_array(untranslated_text, **config)
-        j = 0
-        for i in range(len(translation_list)):
-            text, translated_text = translation_list[i]
-            if translated_text is None:
-                translation_list[i] = (text, self.translation_prefix + '\n\n' + translated_text_list[j])
-                j += 1
         cells = []
         i = 0
         for cell in doc['cells']:
             if cell['cell_type'] == 'markdown':
-                if not replace:
-                    cells.append(cell)
-                cell = json.loads(json.dumps(cell))
-                cell['metadata']['original_source'] = cell['source']
-                cell['source'] = self.ensure_list(translation_list[i][1])
-                cells.append(cell)
+                cells.extend(self.translate_cell(cell, translated_list[i], replace, langs))
                 i += 1
             else:
                 cells.append(cell)
         doc['cells'] = cells
 
+    def translate_cell(self, cell, translated_text, replace=False, langs=None):
+        """Return the cells replacing a markdown cell. When the translation
+        is unchecked, the closest match in the translation memory for the
+        languages `langs' is added to the metadata as a suggestion.
+        """
+        if translated_text is None:
+            return [cell]
+        cells = []
+        if not replace:
+            cells.append(cell)
+        cell = json.loads(json.dumps(cell))
+        cell['metadata']['original_source'] = cell['source']
+        cell['source'] = self.ensure_list(translated_text)
+        memory = self.translation_memory
+        if (memory is not None and not memory.reuse and langs is not None
+                and translated_text.startswith(self.translation_prefix)):
+            match = memory.lookup(self.cell_to_original_markdown(cell), *langs)
+            if match is not None:
+                similarity, source, target = match
+                cell['metadata']['translation_memory'] = {
+                    'similarity': round(similarity, 3),
+                    'source': source,
+                    'translation': target
+                    }
+        cells.append(cell)
+        return cells
+
+    def plan_translation(self, text, translation_dict=None, segment_dict=None, from_lang='en', to_lang='ja'):
+        """Return a list of (text, translated_text, checked) tuples for the
+        segments of the text. The translated text is None when it needs to
+        be translated. The whole text is one segment unless some of its
+        segments are found in `segment_dict'. Otherwise a text found in the
+        translation memory is reused, as checked only if it is the same.
+        """
+        if translation_dict is not None and text in translation_dict:
+            return [(text, translation_dict[text], True)]
+        if segment_dict:
+            segments = split_markdown_blocks(text)
+            plan = [
+                (segment,) + segment_dict.get(segment, (None, False))
+                for segment in segments
+                ]
+            if len(plan) > 1 and any(translated_text is not None for _, translated_text, _ in plan):
+                return plan
+        if self.translation_memory is not None:
+            with stats_timer('memory lookup'):
+                match = self.translation_memory.lookup(text, from_lang, to_lang)
+            if match is not None and match[1] == text:
+                stats_count('memory hits')
+                return [(text, match[2], True)]
+            if match is not None and self.translation_memory.reuse:
+                stats_count('memory fuzzy hits')
+                return [(text, match[2], False)]
+        return [(text, None, False)]
+
+    def get_untranslated_texts(self, plans):
+        texts = {}
+        for plan in plans:
+            if plan is None:
+                continue
+            for text, translated_text, _ in plan:
+                if translated_text is None:
+                    texts[text] = None
+        return list(texts)
+
+    def get_missing_texts(self, plans, translations):
+        """Return the texts of the plans which are missing from the cache in
+        offline mode.
+        """
+        return list(dict.fromkeys(
+            text
+            for plan in plans
+            if plan is not None
+            for text, translated_text, _ in plan
+            if translated_text is None and translations[text] is None))
+
+    def translate_texts(self, texts, **config):
+        if len(texts) == 0:
+            return {}
+        translated_text_list = self.markdown_translator.translate_array(list(texts), **config)
+        return dict(zip(texts, translated_text_list))
+
+    def translate_texts_multi(self, texts_by_lang, **config):
+        translated_lists = self.markdown_translator.translate_array_multi(texts_by_lang, **config)
+        return {
+            to_lang: dict(zip(texts, translated_lists[to_lang]))
+            for to_lang, texts in texts_by_lang.items()
+            }
+
+    def apply_plan(self, plan, translations):
+        if plan is None:
+            return None
+        translated_text = '\n\n'.join([
+            translated_text if translated_text is not None else translations[text]
+            for text, translated_text, _ in plan
+            ])
+        if all(checked for _, _, checked in plan):
+            return translated_text
+        return self.translation_prefix + '\n\n' + translated_text
+
     def get_translations_from_file(self, fname):
         with codecs.open(fname, 'r', 'utf-8-sig') as f:
             doc = json.load(f)
@@ -457,25 +2203,516 @@ class NotebookTranslator:
            if k is not None and not v.startswith(self.translation_prefix)
            }
 
+    def add_to_memory(self, translation_dict, segment_dict, from_lang='en', to_lang='ja'):
+        """Add the checked translations of cells and segments to the
+        translation memory.
+        """
+        items = dict(translation_dict or {})
+        for segment, (translated_segment, checked) in (segment_dict or {}).items():
+            if checked and segment not in items:
+                items[segment] = translated_segment
+        self.translation_memory.add_many(items.items(), from_lang, to_lang)
+
+    def get_segment_translations_from_doc(self, doc):
+        """Return a dict from original segments to (translated_text, checked)
+        for translated cells whose original and translated texts split into
+        the same number of segments.
+        """
+        segment_dict = {}
+        for cell in doc['cells']:
+            if cell['cell_type'] != 'markdown':
+                continue
+            original_text = self.cell_to_original_markdown(cell)
+            if original_text is None:
+                continue
+            translated_text = self.cell_to_markdown(cell)
+            checked = not translated_text.startswith(self.translation_prefix)
+            if not checked:
+                translated_text = translated_text[len(self.translation_prefix):].lstrip('\n')
+            original_segments = split_markdown_blocks(original_text)
+            translated_segments = split_markdown_blocks(translated_text)
+            if len(original_segments) != len(translated_segments):
+                continue
+            for original_segment, translated_segment in zip(original_segments, translated_segments):
+                if checked or original_segment not in segment_dict:
+                    segment_dict[original_segment] = (translated_segment, checked)
+        return segment_dict
+
+
+# Manifest
+
+def _file_hash(fname):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    """Records the hashes of the source and the output of each translated
+    file and the options used, so that directory runs can skip unchanged
+    files without parsing them. Sizes and modification times are compared
+    first so that unchanged files are not even read. Recorded entries are
+    written by `save' at most every `save_interval' seconds, and by
+    `flush'.
+    """
+
+    save_interval = 10.0
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved = time.monotonic()
+        if os.path.exists(fname):
+            with codecs.open(fname, 'r', 'utf-8') as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def options_hash(config):
+        options = {
+            k: v
+            for k, v in config.items()
+            if k not in ('allow_update', 'allow_overwrite')
+            }
+        return hashlib.sha256(json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _key(self, fname):
+        return os.path.relpath(fname, os.path.dirname(os.path.abspath(self.fname))).replace(os.sep, '/')
+
+    def file_state(self, fname):
+        st = os.stat(fname)
+        return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': _file_hash(fname)}
+
+    def _matches(self, fname, state):
+        if not os.path.exists(fname):
+            return False
+        st = os.stat(fname)
+        if st.st_size != state['size']:
+            return False
+        if st.st_mtime_ns == state['mtime_ns']:
+            return True
+        return _file_hash(fname) == state['hash']
+
+    def is_current(self, infname, outfnames, options):
+        entry = self.entries.get(self._key(infname))
+        if entry is None or entry['options'] != options:
+            return False
+        if set(entry['outputs']) != set(self._key(outfname) for outfname in outfnames):
+            return False
+        return self._matches(infname, entry['source']) and all(
+            self._matches(outfname, entry['outputs'][self._key(outfname)])
+            for outfname in outfnames)
+
+    def record(self, infname, source_state, outfnames, options):
+        outputs = {
+            self._key(outfname): self.file_state(outfname)
+            for outfname in outfnames
+            }
+        with self._lock:
+            self.entries[self._key(infname)] = {
+                'options': options,
+                'source': source_state,
+                'outputs': outputs
+                }
+            self._dirty = True
+
+    def save(self):
+        if time.monotonic() - self._saved >= self.save_interval:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            with atomic_open(self.fname) as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            self._dirty = False
+            self._saved = time.monotonic()
+
+
+def translate_files(bing_translator, fnames, jobs=1, corpus=False, stream=False, stats=None, profile=None, manifest=None, input_root=None, memory=None, translators=None, pool=None, skip_unchanged=True, **config):
+    """Translate files with `jobs' worker threads, saving the cache after
+    each file. Each worker has its own NotebookTranslator because the
+    markdown converters are not thread-safe. With `corpus', notebooks are
+    translated together by NotebookTranslator.translate_corpus.
+
+    Statistics are recorded per file as children of `stats', which is
+    returned. With `profile', each file is translated under cProfile and
+    the profile is written to that file name.
+
+    In offline mode, the cells missing from the cache are reported and
+    counted as `missing cells', and their files are not written.
+
+    Translated files are recorded in `manifest', and with
+    `skip_unchanged' files recorded as unchanged are skipped. With
+    `input_root', outputs keep the directory structure under it. `memory'
+    is a TranslationMemory shared by the workers. `translators' is a
+    queue.LifoQueue of idle NotebookTranslators, which are reused across
+    calls by whichever thread makes them. `pool' is a process pool made by make_conversion_pool
+    shared by the workers.
+    """
+    if stats is None:
+        stats = Stats()
+    options = Manifest.options_hash(config)
+
+    def file_config(fname):
+        res = dict(config)
+        if input_root is not None and config.get('output_dir') is not None:
+            res['output_dir'] = os.path.join(config['output_dir'], os.path.relpath(os.path.dirname(fname), input_root))
+            os.makedirs(res['output_dir'], exist_ok=True)
+        return res
+
+    to_langs = config.get('to_lang', 'ja')
+    if isinstance(to_langs, str):
+        to_langs = [to_langs]
+
+    def output_fnames(fname, to_langs=to_langs):
+        ext = os.path.splitext(fname)[1][1:]
+        return [
+            NotebookTranslator._make_outfname(fname, None, file_config(fname).get('output_dir'), to_lang, ext)
+            for to_lang in to_langs
+            ]
+
+    if manifest is not None and skip_unchanged:
+        skipped = [fname for fname in fnames if manifest.is_current(fname, output_fnames(fname), options)]
+        if len(skipped) > 0:
+            print('Skipping %d unchanged files.' % (len(skipped),))
+        skipped = set(skipped)
+        fnames = [fname for fname in fnames if fname not in skipped]
+    source_states = {}
+
+    def report_missing(ex):
+        for fname, texts in ex.missing.items():
+            print('%s: %d cells missing from the cache:' % (fname, len(texts)))
+            for text in texts:
+                print('  %s' % (text.strip().split('\n')[0][:72],))
+            stats_count('missing cells', len(texts))
+
+    def record(fname):
+        if manifest is not None:
+            manifest.record(fname, source_states[fname], output_fnames(fname), options)
+            manifest.save()
+
+    idle = translators if translators is not None else queue.LifoQueue()
+
+    def translate_with(nt, fname):
+        print('Translating %s...' % (fname,))
+        if manifest is not None:
+            source_states[fname] = manifest.file_state(fname)
+        with Stats(fname, stats).activate():
+            try:
+                if profile is None:
+                    nt.translate_file(fname, **file_config(fname))
+                else:
+                    import cProfile
+                    profiler = cProfile.Profile()
+                    profiler.runcall(nt.translate_file, fname, **file_config(fname))
+                    profiler.dump_stats(profile)
+            except CacheMissError as ex:
+                report_missing(ex)
+                return
+            with stats_timer('cache save'):
+                bing_translator.save_cache()
+        record(fname)
+
+    def translate_one(fname):
+        try:
+            nt = idle.get_nowait()
+        except queue.Empty:
+            nt = NotebookTranslator(bing_translator, stream=stream, memory=memory, pool=pool)
+        try:
+            translate_with(nt, fname)
+        finally:
+            idle.put(nt)
+
+    try:
+        if corpus:
+            notebooks = [fname for fname in fnames if fname.endswith('.ipynb')]
+            with Stats('(corpus)', stats).activate():
+                nt = NotebookTranslator(bing_translator, stream=stream, memory=memory, pool=pool)
+                if manifest is not None:
+                    for fname in notebooks:
+                        source_states[fname] = manifest.file_state(fname)
+                missing = set()
+                for to_lang in to_langs:
+                    try:
+                        nt.translate_corpus(
+                            notebooks, outfnames=[output_fnames(fname, [to_lang])[0] for fname in notebooks],
+                            **dict(config, to_lang=to_lang))
+                    except CacheMissError as ex:
+                        report_missing(ex)
+                        missing.update(ex.missing)
+                with stats_timer('cache save'):
+                    bing_translator.save_cache()
+            for fname in notebooks:
+                if fname not in missing:
+                    record(fname)
+            fnames = [fname for fname in fnames if not fname.endswith('.ipynb')]
+
+        if jobs <= 1:
+            for fname in fnames:
+                translate_one(fname)
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=jobs)
+            try:
+                for _ in executor.map(translate_one, fnames):
+                    pass
+            finally:
+                executor.shutdown(cancel_futures=True)
+    finally:
+        # Also on errors and interrupts, so that completed files are kept.
+        if manifest is not None:
+            manifest.flush()
+    return stats
+
+
+def find_notebooks(input_root, to_langs, recursive=False):
+    """Return the notebooks under `input_root', excluding translated
+    notebooks and checkpoints.
+    """
+    if recursive:
+        pattern = os.path.join(input_root, '**', '*.ipynb')
+    else:
+        pattern = os.path.join(input_root, '*.ipynb')
+    import glob
+    return [
+        fname
+        for fname in sorted(glob.glob(pattern, recursive=True))
+        if not any(fname.endswith('_%s.ipynb' % (lang,)) for lang in to_langs)
+        and '.ipynb_checkpoints' not in fname.split(os.sep)
+        ]
+
+
+def shard_files(fnames, index, count, by='size'):
+    """Return the files of the shard `index' (from 0) of `count'. By size,
+    the largest files are assigned first to the least loaded shard so that
+    the shards take about the same time. By hash, a file stays in the
+    same shard whatever the other files are.
+    """
+    if by == 'hash':
+        return [
+            fname
+            for fname in fnames
+            if int(hashlib.sha256(fname.replace(os.sep, '/').encode('utf-8')).hexdigest(), 16) % count == index
+            ]
+    loads = [0] * count
+    assigned = set()
+    for fname in sorted(fnames, key=lambda fname: (-os.path.getsize(fname), fname)):
+        shard = loads.index(min(loads))
+        loads[shard] += os.path.getsize(fname)
+        if shard == index:
+            assigned.add(fname)
+    return [fname for fname in fnames if fname in assigned]
+
+
+def merge_cache_main(argv):
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='jupyter_translate.py merge-cache', description='Merge translation cache shards into a cache.')
+    parser.add_argument('output', help='Cache file to merge into.')
+    parser.add_argument('shards', nargs='+', help='Cache shards to merge.')
+    args = parser.parse_args(argv)
+
+    cache = TranslationCache(args.output)
+    for fname in args.shards:
+        n = cache.merge(fname)
+        print('Merged %d entries from %s.' % (n, fname))
+    print('%d entries in %s.' % (len(cache), args.output))
+    cache.close()
+
+
+# Daemon
+
+class TranslationDaemon:
+    """Keeps the translator, its cache and the notebook translators in
+    memory, and retranslates the notebooks under `input_root' as they
+    change. Changes are found by polling the sizes and modification times
+    of the notebooks, and translation starts once no more changes are
+    seen for `debounce' seconds. Unchanged cells are taken from the
+    previous outputs and the cache, so only changed cells are sent.
+
+    `serve' starts a small HTTP API on localhost:
+
+      POST /translate  {"paths": [...]} translates the notebooks, or all of
+                       them without paths, and returns the statistics.
+      GET /status      returns the number of notebooks and cached texts.
+    """
+
+    poll_interval = 0.2
+    debounce = 0.3
+
+    def __init__(self, bing_translator, input_root, manifest, recursive=False, jobs=1, stream=False, memory=None, pool=None, **config):
+        self.bing_translator = bing_translator
+        self.input_root = input_root
+        self.manifest = manifest
+        self.recursive = recursive
+        self.jobs = jobs
+        self.stream = stream
+        self.memory = memory
+        self.pool = pool
+        self.config = dict(config, allow_update=True)
+        to_langs = config.get('to_lang', 'ja')
+        self.to_langs = [to_langs] if isinstance(to_langs, str) else to_langs
+        self._translators = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._states = {}
+
+    def find_notebooks(self):
+        return find_notebooks(self.input_root, self.to_langs, self.recursive)
+
+    def translate(self, fnames=None):
+        """Translate notebooks, skipping those unchanged since their last
+        translation, and return the statistics.
+        """
+        if fnames is None:
+            fnames = self.find_notebooks()
+        with self._lock:
+            stats = translate_files(
+                self.bing_translator, fnames, jobs=self.jobs, stream=self.stream,
+                manifest=self.manifest, input_root=self.input_root, memory=self.memory,
+                translators=self._translators, pool=self.pool, **self.config)
+        return stats
+
+    def poll(self):
+        """Return the notebooks added or changed since the last poll."""
+        states = {}
+        for fname in self.find_notebooks():
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            states[fname] = (st.st_size, st.st_mtime_ns)
+        changed = [fname for fname, state in states.items() if self._states.get(fname) != state]
+        self._states = states
+        return changed
+
+    def watch(self, stop=None):
+        """Retranslate changed notebooks until `stop', a threading.Event,
+        is set.
+        """
+        self.poll()
+        while stop is None or not stop.is_set():
+            changed = self.poll()
+            if len(changed) == 0:
+                time.sleep(self.poll_interval)
+                continue
+            while True:
+                time.sleep(self.debounce)
+                more = self.poll()
+                if len(more) == 0:
+                    break
+                changed.extend(fname for fname in more if fname not in changed)
+            try:
+                start = time.perf_counter()
+                self.translate(changed)
+                print('Translated %d notebooks in %.3f s.' % (len(changed), time.perf_counter() - start))
+            except Exception as e:
+                print('Translation failed: %s' % (e,))
+
+    def serve(self, port, host='127.0.0.1'):
+        """Start the HTTP API in a background thread and return the
+        server.
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        daemon = self
+        root = os.path.realpath(self.input_root)
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def _reply(self, status, data):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path != '/status':
+                    return self._reply(404, {'error': 'Not found'})
+                self._reply(200, {
+                    'notebooks': len(daemon.find_notebooks()),
+                    'cache': len(daemon.bing_translator.cache)
+                    })
+
+            def do_POST(self):
+                if self.path != '/translate':
+                    return self._reply(404, {'error': 'Not found'})
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    request = json.loads(self.rfile.read(length) or b'{}')
+                    fnames = None
+                    if request.get('paths') is not None:
+                        fnames = [os.path.join(root, path) for path in request['paths']]
+                        for fname in fnames:
+                            if not os.path.realpath(fname).startswith(root + os.sep):
+                                return self._reply(400, {'error': "`%s' is outside the input directory" % (fname,)})
+                    stats = daemon.translate(fnames)
+                except Exception as e:
+                    return self._reply(500, {'error': str(e)})
+                self._reply(200, stats.to_dict())
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
 
 def main():
 
     import argparse
     import glob
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge-cache':
+        return merge_cache_main(sys.argv[2:])
 
     parser = argparse.ArgumentParser(description='Translate Jupyter notebook using Bing Translator API.')
     parser.add_argument('--key', '-k', nargs='?', help='Bing Translator API secret key.', type=str)
     parser.add_argument('--key-file', nargs='?', help='Use Bing Translator API secret key from file.', type=str, default='bing.key')
     parser.add_argument('--from', nargs='?', dest='from_lang', help='Language to translate from.', type=str, default='en')
-    parser.add_argument('--to', nargs='?', dest='to_lang', help='Language to translate to.', type=str, default='ja')
+    parser.add_argument('--to', nargs='?', dest='to_lang', help='Language to translate to, or comma-separated languages.', type=str, default='ja')
     parser.add_argument('--output-directory', '-d', nargs='?', dest='output_dir', help='Output directory', type=str, default=None)
     parser.add_argument('--preserve', '-p', dest='preserve', help='Preserve original texts.', default=False, action='store_true')
     parser.add_argument('--force', '-f', dest='allow_overwrite', help='Allow overwrite old files.', default=False, action='store_true')
     parser.add_argument('--update', '-u', dest='allow_update', help='Allow update files.', default=False, action='store_true')
+    parser.add_argument('--cache-file', dest='cache_fname', help='Translation cache file.', type=str, default='bing.cache.sqlite')
+    parser.add_argument('--cache-max-entries', dest='cache_max_entries', help='Evict the oldest cache entries beyond this number.', type=int, default=None)
+    parser.add_argument('--cache-max-age', dest='cache_max_age', help='Evict cache entries older than this number of days.', type=float, default=None)
+    parser.add_argument('--cache-layer', dest='cache_layers', help='Read-only cache, such as a shard of a sharded run, read after the cache file. Can be repeated.', type=str, action='append', default=[])
+    parser.add_argument('--shard', dest='shard', help='Translate only the shard i (from 1) of N of the inputs, given as i/N.', type=str, default=None)
+    parser.add_argument('--shard-by', dest='shard_by', help='Partition the inputs by size to balance the shards, or by hash of the file name.', choices=['size', 'hash'], default='size')
+    parser.add_argument('--offline', '--cache-only', dest='offline', help='Translate only from the cache without network access, and report the cells missing from it.', default=False, action='store_true')
+    parser.add_argument('--concurrency', dest='max_concurrency', help='Maximum number of requests in flight for the whole run. The default is 4, or --jobs if larger.', type=int, default=None)
+    parser.add_argument('--timeout', dest='timeout', help='Seconds to wait for a response before retrying a request.', type=float, default=120.0)
+    parser.add_argument('--resume', dest='resume', help='Continue an interrupted directory run, skipping the files it completed.', default=False, action='store_true')
+    parser.add_argument('--watch', dest='watch', help='Keep running and retranslate notebooks as they change in directory mode.', default=False, action='store_true')
+    parser.add_argument('--serve', dest='serve', help='Keep running and serve an HTTP API on this local port in directory mode.', type=int, default=None)
+    parser.add_argument('--recursive', '-r', dest='recursive', help='Translate notebooks in subdirectories too in directory mode.', default=False, action='store_true')
+    parser.add_argument('--jobs', '-j', dest='jobs', help='Number of files to translate in parallel.', type=int, default=1)
+    parser.add_argument('--processes', dest='processes', help='Number of processes converting Markdown and HTML.', type=int, default=None)
+    parser.add_argument('--corpus', dest='corpus', help='Translate notebooks together, sending each distinct text only once.', default=False, action='store_true')
+    parser.add_argument('--stream', dest='stream', help='Stream notebooks without loading code cell outputs into memory.', default=False, action='store_true')
+    parser.add_argument('--stats', dest='stats', help='Print timers and counters per file and in total.', default=False, action='store_true')
+    parser.add_argument('--stats-json', dest='stats_json', help='Write timers and counters to a JSON file.', type=str, default=None)
+    parser.add_argument('--profile', dest='profile', help='Profile the translation of a single file and write the profile to this file.', type=str, default=None)
+    parser.add_argument('--memory', dest='memory_fname', help='Translation memory file of reviewed translations.', type=str, default=None)
+    parser.add_argument('--memory-threshold', dest='memory_threshold', help='Minimum similarity of a translation memory match.', type=float, default=0.8)
+    parser.add_argument('--memory-reuse', dest='memory_reuse', help='Use similar translations in the translation memory instead of suggesting them.', default=False, action='store_true')
+    parser.add_argument('--memory-import', dest='memory_import', help='Add the reviewed translations in the input notebooks to the translation memory and exit.', default=False, action='store_true')
     parser.add_argument('inputs', nargs='+', help="Input files.")
     args = parser.parse_args()
 
-    if args.key is not None:
+    if args.offline:
+        key = None
+    elif args.key is not None:
         key = args.key
     elif args.key_file is not None:
         with open(args.key_file, 'r') as f:
@@ -485,43 +2722,121 @@ def main():
     fnames = args.inputs
     from_lang = args.from_lang
     to_lang = args.to_lang
+    if ',' in to_lang:
+        to_lang = to_lang.split(',')
     output_dir = args.output_dir
     preserve = args.preserve
     allow_update = args.allow_update
+    if args.watch or args.serve is not None:
+        # The daemon retranslates the notebooks it has translated before.
+        allow_update = True
     allow_overwrite = args.allow_overwrite
 
-    bt = BingTranslator(key)
-    bt.load_cache()
-    nt = NotebookTranslator(bt)
+    memory = None
+    if args.memory_fname is not None:
+        memory = TranslationMemory(args.memory_fname, threshold=args.memory_threshold, reuse=args.memory_reuse)
+    elif args.memory_import:
+        raise Exception('--memory-import needs --memory.')
+    if args.memory_import:
+        if not isinstance(to_lang, str):
+            raise Exception('--memory-import needs a single language to translate to.')
+        nt = NotebookTranslator(None, memory=memory)
+        for arg in fnames:
+            for fname in glob.glob(arg):
+                doc = nt._load_notebook(fname)
+                nt.add_to_memory(
+                    nt.get_translations_from_doc(doc), nt.get_segment_translations_from_doc(doc),
+                    from_lang, to_lang)
+        print('%d texts in the translation memory.' % (len(memory),))
+        return
+
+    stats = Stats()
+    with stats.activate():
+        max_concurrency = args.max_concurrency
+        if max_concurrency is None:
+            max_concurrency = max(4, args.jobs)
+        bt = BingTranslator(
+            key, cache_fname=args.cache_fname, max_concurrency=max_concurrency, cache_layers=args.cache_layers,
+            timeout=(10.0, args.timeout))
+        bt.offline = args.offline
+    manifest = None
+    input_root = None
     if len(fnames) == 1 and os.path.isdir(fnames[0]):
         print(to_lang)
         print('Directory mode. Translating files under directory...')
-        for fname in glob.glob(os.path.join(fnames[0], '*.ipynb')):
-            if not fname.endswith('_%s.ipynb' % (to_lang,)):
-                print('Translating %s...' % (fname,))
-                nt.translate_file(
-                    fname, from_lang=from_lang, to_lang=to_lang,
-                    category='generalnn', allow_update=allow_update,
-                    allow_overwrite=allow_overwrite,
-                    output_dir=output_dir, replace=not preserve)
-                bt.save_cache()
+        input_root = fnames[0]
+        fnames = find_notebooks(input_root, to_lang if isinstance(to_lang, list) else [to_lang], args.recursive)
+        # Every directory run is recorded so that it can be resumed.
+        manifest = Manifest(os.path.join(output_dir or input_root, '.jupyter_translate_manifest.json'))
     else:
-        for arg in fnames:
-            found = False
-            for fname in glob.glob(arg):
-                print('Translating %s...' % (fname,))
-                nt.translate_file(
-                    fname, from_lang=from_lang, to_lang=to_lang,
-                    category='generalnn', allow_update=allow_update,
-                    allow_overwrite=allow_overwrite,
-                    output_dir=output_dir, replace=not preserve)
-                bt.save_cache()
-                found = True
-            if not found:
+        if args.resume or args.watch or args.serve is not None:
+            raise Exception('--resume, --watch and --serve need an input directory.')
+        inputs = fnames
+        fnames = []
+        for arg in inputs:
+            found = glob.glob(arg)
+            if len(found) == 0:
                 raise Exception('Input file `%s\' not found.' % arg)
-
+            fnames.extend(found)
+    if args.shard is not None:
+        m = re.match(r'^(\d+)/(\d+)$', args.shard)
+        if m is None or not 1 <= int(m.group(1)) <= int(m.group(2)):
+            raise Exception("Invalid shard `%s'. Use i/N with 1 <= i <= N." % (args.shard,))
+        count = len(fnames)
+        fnames = shard_files(fnames, int(m.group(1)) - 1, int(m.group(2)), args.shard_by)
+        print('Shard %s: %d of %d files.' % (args.shard, len(fnames), count))
+    if args.profile is not None and len(fnames) != 1:
+        raise Exception('--profile needs a single input file.')
+    pool = None
+    if args.processes is not None and args.processes > 1:
+        pool = make_conversion_pool(args.processes)
+    config = dict(
+        from_lang=from_lang, to_lang=to_lang,
+        category='generalnn', allow_update=allow_update,
+        allow_overwrite=allow_overwrite,
+        output_dir=output_dir, replace=not preserve)
+    translate_files(
+        bt, fnames, jobs=args.jobs, corpus=args.corpus, stream=args.stream,
+        stats=stats, profile=args.profile, manifest=manifest, input_root=input_root, memory=memory,
+        pool=pool, skip_unchanged=allow_update or args.resume, **config)
+    if args.cache_max_entries is not None or args.cache_max_age is not None:
+        bt.cache.evict(
+            max_entries=args.cache_max_entries,
+            max_age=args.cache_max_age * 86400 if args.cache_max_age is not None else None)
+    if args.stats:
+        for child in stats.children:
+            print(child.report())
+        print(stats.report())
+    if args.stats_json is not None:
+        with open(args.stats_json, 'w') as f:
+            json.dump(stats.to_dict(), f, indent=1, sort_keys=True)
+    if args.watch or args.serve is not None:
+        daemon = TranslationDaemon(
+            bt, input_root, manifest, recursive=args.recursive, jobs=args.jobs,
+            stream=args.stream, memory=memory, pool=pool, **config)
+        server = None
+        if args.serve is not None:
+            server = daemon.serve(args.serve)
+            print('Serving on http://127.0.0.1:%d/' % (server.server_address[1],))
+        try:
+            if args.watch:
+                print('Watching %s...' % (input_root,))
+                daemon.watch()
+            else:
+                threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if server is not None:
+                server.shutdown()
+    if pool is not None:
+        pool.shutdown()
+    missing = stats.counts.get('missing cells', 0)
+    if missing > 0:
+        print('%d cells are missing from the cache.' % (missing,))
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
 
-__all__ = ['BingTranslator', 'MarkdownTranslator', 'MathExtension']
\ No newline at end of file
+__all__ = ['BingTranslator', 'CacheMissError', 'RequestScheduler', 'TransientError', 'TranslatorBackend', 'TranslationCache', 'TranslationMemory', 'TranslationDaemon', 'MarkdownTranslator', 'MathExtension', 'Manifest', 'NotebookStream', 'NotebookTranslator', 'Stats', 'atomic_open', 'find_notebooks', 'make_conversion_pool', 'needs_translation', 'shard_files', 'translate_files']
\ No newline at end of file
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+# Benchmarks for Jupyter Translate
+
+import os
+import json
+import random
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from jupyter_translate import *
+
+
+SAMPLE_MARKDOWN = u'''## Section
+
+This is a *sample* paragraph with **strong** text, `inline code`, a
+[link](https://example.com/) and math $x^2 + y^2$.
+
+- First item
+- Second item
+    1. Nested item
+    2. Another nested item
+
+> A quoted paragraph.
+
+    print("Hello")
+
+---
+'''
+
+
+# Mock server
+
+class MockTranslatorServer:
+    """A local stand-in for the Translator Text API V2 endpoints used by
+    BingTranslator. Requests are delayed by `latency' seconds, fail with
+    status 500 at `error_rate', and are answered with status 429 beyond
+    `rate_limit' requests per second. Texts are translated by
+    `translate_func', which returns them unchanged by default.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, rate_limit=None, translate_func=None, port=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.translate_func = translate_func or (lambda text, to_lang: text)
+        self.requests = 0
+        self.chars = 0
+        self.errors = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self._window = (0, 0)
+        self._random = random.Random(0)
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._make_handler())
+        self._server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d' % (self._server.server_address[1],)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _admit(self, chars):
+        """Return the error status for a request, or None to serve it."""
+        with self._lock:
+            self.requests += 1
+            if self.rate_limit is not None:
+                second = int(time.time())
+                start, count = self._window
+                if start != second:
+                    start, count = second, 0
+                if count >= self.rate_limit:
+                    self.throttled += 1
+                    return 429
+                self._window = (start, count + 1)
+            if self._random.random() < self.error_rate:
+                self.errors += 1
+                return 500
+            self.chars += chars
+        return None
+
+    def _make_handler(self):
+        server = self
+        ns = 'http://schemas.datacontract.org/2004/07/Microsoft.MT.Web.Service.V2'
+        arrays_ns = 'http://schemas.microsoft.com/2003/10/Serialization/Arrays'
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, body=b''):
+                self.send_response(status)
+                if status == 429:
+                    self.send_header('Retry-After', '1')
+                self.send_header('Content-Type', 'application/xml')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                if not url.path.endswith('/Translate'):
+                    return self._reply(404)
+                query = urllib.parse.parse_qs(url.query)
+                text = query['text'][0]
+                time.sleep(server.latency)
+                status = server._admit(len(text))
+                if status is not None:
+                    return self._reply(status)
+                root = ET.Element('{http://schemas.microsoft.com/2003/10/Serialization/}string')
+                root.text = server.translate_func(text, query['to'][0])
+                self._reply(200, ET.tostring(root, encoding='utf-8'))
+
+            def do_POST(self):
+                if not self.path.endswith('/TranslateArray'):
+                    return self._reply(404)
+                data = self.rfile.read(int(self.headers['Content-Length']))
+                root = ET.fromstring(data)
+                to_lang = root.find('To').text
+                texts = [elem.text or '' for elem in root.iter('{%s}string' % (arrays_ns,))]
+                time.sleep(server.latency)
+                status = server._admit(sum(len(text) for text in texts))
+                if status is not None:
+                    return self._reply(status)
+                res = ET.Element('{%s}ArrayOfTranslateArrayResponse' % (ns,))
+                for text in texts:
+                    elem = ET.SubElement(res, '{%s}TranslateArrayResponse' % (ns,))
+                    ET.SubElement(elem, '{%s}TranslatedText' % (ns,)).text = server.translate_func(text, to_lang)
+                self._reply(200, ET.tostring(res, encoding='utf-8'))
+
+        return Handler
+
+
+# Synthetic corpus
+
+WORDS = (
+    'data model training the a of to and is in we for with this that '
+    'function value array plot result network layer loss learning rate '
+    'sample feature vector matrix input output example step'
+    ).split()
+
+
+def make_sentence(rng, n):
+    words = [rng.choice(WORDS) for _ in range(n)]
+    return ' '.join(words).capitalize() + '.'
+
+
+def make_markdown_cell(rng):
+    kind = rng.randrange(6)
+    if kind == 0:
+        return '## ' + make_sentence(rng, 4)[:-1]
+    elif kind == 1:
+        return '\n'.join(['- ' + make_sentence(rng, 6) for _ in range(rng.randint(2, 6))])
+    elif kind == 2:
+        return make_sentence(rng, 10) + ' We use $\\alpha x^2 + \\beta$ here.\n\n$$\\sum_{i=1}^n x_i$$'
+    elif kind == 3:
+        return make_sentence(rng, 8) + '\n\n```python\nmodel.fit(x, y, epochs=%d)\n```' % rng.randint(1, 100)
+    elif kind == 4:
+        return '![figure](images/figure%d.png)' % rng.randint(1, 10)
+    return '\n\n'.join([
+        ' '.join([make_sentence(rng, rng.randint(6, 20)) for _ in range(rng.randint(2, 5))])
+        for _ in range(rng.randint(1, 4))
+        ])
+
+
+def make_notebook(rng, cells, output_size):
+    doc = {'cells': [], 'metadata': {}, 'nbformat': 4, 'nbformat_minor': 2}
+    for i in range(cells):
+        doc['cells'].append({'cell_type': 'markdown', 'metadata': {}, 'source': make_markdown_cell(rng)})
+        doc['cells'].append({
+            'cell_type': 'code', 'execution_count': i + 1, 'metadata': {},
+            'outputs': [{
+                'data': {'image/png': 'iVBORw0KGgo' * (output_size // 11)},
+                'metadata': {}, 'output_type': 'display_data'
+                }],
+            'source': ['plt.plot(x, y)']
+            })
+    return doc
+
+
+def make_corpus(dirname, notebooks=20, cells=30, output_size=10000, seed=0):
+    rng = random.Random(seed)
+    fnames = []
+    for i in range(notebooks):
+        fname = os.path.join(dirname, 'notebook%04d.ipynb' % (i,))
+        with open(fname, 'w') as f:
+            json.dump(make_notebook(rng, cells, output_size), f, indent=1, sort_keys=True)
+        fnames.append(fname)
+    return fnames
+
+
+# Benchmarks
+
+def peak_memory():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def bench_pipeline(notebooks=20, cells=30, output_size=10000, latency=0.05, error_rate=0.0, rate_limit=None, jobs=1, concurrency=4, corpus=False, stream=False, processes=None, warm=False):
+    """Translate a synthetic corpus against MockTranslatorServer and
+    return the throughput, peak memory and time per stage. With `warm',
+    the corpus is translated once before the measured run, so that all
+    the texts are cached.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fnames = make_corpus(tmpdir, notebooks, cells, output_size)
+        stats = Stats()
+        pool = make_conversion_pool(processes) if processes is not None and processes > 1 else None
+        with MockTranslatorServer(latency, error_rate, rate_limit) as server:
+            if warm:
+                bt = BingTranslator(
+                    'mock', cache_fname=os.path.join(tmpdir, 'bench.cache.sqlite'),
+                    legacy_cache_fname=None, max_concurrency=concurrency, endpoint=server.url)
+                translate_files(bt, fnames, jobs=jobs, from_lang='en', to_lang='ja', replace=True)
+                bt.cache.close()
+                server.requests = server.chars = 0
+            start = time.perf_counter()
+            with stats.activate():
+                bt = BingTranslator(
+                    'mock', cache_fname=os.path.join(tmpdir, 'bench.cache.sqlite'),
+                    legacy_cache_fname=None, max_concurrency=concurrency, endpoint=server.url)
+            translate_files(
+                bt, fnames, jobs=jobs, corpus=corpus, stream=stream, stats=stats, pool=pool,
+                from_lang='en', to_lang='ja', replace=True, allow_overwrite=True)
+            elapsed = time.perf_counter() - start
+            bt.cache.close()
+        if pool is not None:
+            pool.shutdown()
+        return {
+            'notebooks': notebooks,
+            'seconds': elapsed,
+            'notebooks_per_sec': notebooks / elapsed,
+            'chars': server.chars,
+            'chars_per_sec': server.chars / elapsed,
+            'requests': server.requests,
+            'peak_memory_mb': peak_memory(),
+            'stages': stats.times,
+            'counts': stats.counts
+            }
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_unmarkdown(repeat=5):
+    """Time Unmarkdown.convert on documents of doubling size. The time per
+    copy of the sample should stay flat if conversion is linear.
+    """
+    mt = MarkdownTranslator(None)
+    res = {}
+    for n in [50, 100, 200, 400, 800]:
+        html = mt.markdown(SAMPLE_MARKDOWN * n)
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            mt.unmarkdown(html)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        res[n] = best
+        print('unmarkdown %4d copies %8.2f ms %8.3f ms/copy' % (n, best * 1000, best * 1000 / n))
+    return res
+
+
+def main():
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark Jupyter Translate against a local mock server.')
+    parser.add_argument('--notebooks', type=int, default=20, help='Number of notebooks in the corpus.')
+    parser.add_argument('--cells', type=int, default=30, help='Number of markdown cells per notebook.')
+    parser.add_argument('--output-size', type=int, default=10000, help='Size of each code cell output.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Latency of the mock server in seconds.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Rate of failing requests.')
+    parser.add_argument('--rate-limit', type=int, default=None, help='Requests per second before throttling.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of notebooks to translate in parallel.')
+    parser.add_argument('--concurrency', type=int, default=4, help='Maximum number of requests in flight.')
+    parser.add_argument('--corpus', default=False, action='store_true', help='Use corpus mode.')
+    parser.add_argument('--stream', default=False, action='store_true', help='Use stream mode.')
+    parser.add_argument('--processes', type=int, default=None, help='Number of processes converting Markdown and HTML.')
+    parser.add_argument('--warm', default=False, action='store_true', help='Measure a run with all the texts cached.')
+    parser.add_argument('--json', dest='json_fname', default=None, help='Write the results to a JSON file.')
+    args = parser.parse_args()
+
+    results = {'unmarkdown': bench_unmarkdown()}
+    res = bench_pipeline(
+        args.notebooks, args.cells, args.output_size, args.latency, args.error_rate,
+        args.rate_limit, args.jobs, args.concurrency, args.corpus, args.stream,
+        args.processes, args.warm)
+    results['pipeline'] = res
+    print('pipeline %d notebooks in %.2f s: %.2f notebooks/s, %.0f chars/s, %d requests, peak %s MB' % (
+        res['notebooks'], res['seconds'], res['notebooks_per_sec'], res['chars_per_sec'],
+        res['requests'], '%.1f' % res['peak_memory_mb'] if res['peak_memory_mb'] is not None else '-'))
+    for stage, t in sorted(res['stages'].items()):
+        print('  %-20s %8.3f s' % (stage, t))
+    if args.json_fname is not None:
+        with open(args.json_fname, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
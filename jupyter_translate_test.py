@@ -1,6 +1,12 @@
 from jupyter_translate import *
 import unittest
 import markdown
+import json
+import urllib.parse
+import os
+import shutil
+import tempfile
+from jupyter_translate_bench import MockTranslatorServer
 
 
 class TestJupyterTranslate(unittest.TestCase):
@@ -48,5 +54,668 @@ class TestJupyterTranslate(unittest.TestCase):
             print(x)
 
 
+class FakeBingTranslator:
+
+    def __init__(self):
+        self.requests = []
+        self.to_langs = []
+
+    def save_cache(self):
+        pass
+
+    def translate_array_safe(self, text_list, **config):
+        self.requests.append(list(text_list))
+        self.to_langs.append(config.get('to_lang'))
+        return [text.replace('Hello', 'Konnichiwa') for text in text_list]
+
+
+def make_notebook(*sources):
+    return {
+        'cells': [
+            {'cell_type': 'markdown', 'metadata': {}, 'source': source}
+            for source in sources
+            ],
+        'metadata': {},
+        'nbformat': 4,
+        'nbformat_minor': 2
+        }
+
+
+class TestOffline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_notebook(self, name, *sources):
+        fname = os.path.join(self.tmpdir, name)
+        with open(fname, 'w') as f:
+            json.dump(make_notebook(*sources), f)
+        return fname
+
+    def read_file(self, fname):
+        with open(fname, 'rb') as f:
+            return f.read()
+
+    def test_unmarkdown(self):
+        mt = MarkdownTranslator(None)
+        t = u'''##### Heading *five*
+
+Text with `code`, [link](https://example.com/) and $x^2$.  
+Next line.
+
+- Item
+    1. Nested
+    2. Nested
+
+---
+
+<table><tr><td>Cell</td></tr></table>'''
+        self.assertEqual(mt.unmarkdown(mt.markdown(t)), t)
+
+        t = u'''Escaped \\*star\\* and \\_under\\_, my_func, \\_\\_init\\_\\_, \\[not a link\\] and \\`tick\\`.
+
+See https://en.wikipedia.org/wiki/Gradient_descent.
+
+Entities &lt;br> and &amp;lt; stay text, and 1 < 2 & 3.
+
+\\# Not a heading
+
+1999\\. Not a list  
+\\- Not an item'''
+        self.assertEqual(mt.unmarkdown(mt.markdown(t)), t)
+
+    def test_masking(self):
+        bt = FakeBingTranslator()
+        mt = MarkdownTranslator(bt)
+        t = u'''Hello $E = mc^2$ and $$\\sum_i x_i$$ with `x = [1, 2]`.
+
+```
+y = "$1"
+```
+See [docs](https://example.com/a/long/path.html) <img src="a.png" width="10">'''
+        res = mt.translate_array([t], from_lang='en', to_lang='ja')
+        self.assertEqual(res, [t.replace('Hello', 'Konnichiwa')])
+        self.assertNotIn('mc^2', bt.requests[0][0])
+        self.assertNotIn('example.com', bt.requests[0][0])
+
+        # Dollar signs and backticks in separate paragraphs are not masked
+        # together.
+        t = 'It costs $5 per month.\n\nThe premium plan is better and costs $20.\n\nA lone ` here.\n\nAnd ` there.'
+        masked_text, spans = mt.mask(t)
+        self.assertEqual(masked_text, t)
+        self.assertEqual(spans, [])
+
+        # Literal placeholders are kept, and bare URLs are not sent.
+        bt.requests = []
+        t = 'Hello $x$ with jt:5 and jt:0, [a](jt:1) <m i="0"></m> and https://example.com/a_b_c.'
+        self.assertEqual(mt.translate_array([t], from_lang='en', to_lang='ja'), [t.replace('Hello', 'Konnichiwa')])
+        self.assertNotIn('example.com', bt.requests[0][0])
+
+        # In HTML cells, the spans are restored as HTML.
+        t = '<div align="center"><img src="a.png"></div>\n\nHello, use `fit()` with $x$ and [docs](http://a.com/?a=1&b=2).\n\n```\nx = 1\n```'
+        self.assertEqual(
+            mt.translate_array([t], from_lang='en', to_lang='ja'),
+            MarkdownTranslator(bt, masking=False).translate_array([t], from_lang='en', to_lang='ja'))
+
+    def test_translate_files_jobs(self):
+        fnames = [
+            self.write_notebook('n%d.ipynb' % i, 'Hello %d' % i, '- Hello *world*')
+            for i in range(8)
+            ]
+        translate_files(FakeBingTranslator(), fnames, to_lang='ja')
+        sequential = [self.read_file(fname.replace('.ipynb', '_ja.ipynb')) for fname in fnames]
+        stats = translate_files(FakeBingTranslator(), fnames, jobs=4, to_lang='ja', allow_overwrite=True)
+        self.assertEqual(sorted(child.name for child in stats.children), sorted(fnames))
+        self.assertIn('markdown', stats.times)
+        self.assertIn('json dump', stats.children[0].times)
+        parallel = [self.read_file(fname.replace('.ipynb', '_ja.ipynb')) for fname in fnames]
+        self.assertEqual(sequential, parallel)
+        self.assertIn(b'Konnichiwa 3', sequential[3])
+
+    def test_translate_corpus(self):
+        fnames = [
+            self.write_notebook('n%d.ipynb' % i, 'Hello %d' % i, 'Run the cell below.')
+            for i in range(3)
+            ]
+        bt = FakeBingTranslator()
+        translate_files(bt, fnames, corpus=True, to_lang='ja')
+        self.assertEqual(bt.requests, [['<p>Hello 0</p>', '<p>Run the cell below.</p>', '<p>Hello 1</p>', '<p>Hello 2</p>']])
+        with open(os.path.join(self.tmpdir, 'n2_ja.ipynb')) as f:
+            doc = json.load(f)
+        self.assertEqual(''.join(doc['cells'][1]['source']), '_unchecked_\n\nKonnichiwa 2')
+
+    def test_translate_multiple_languages(self):
+        fname = self.write_notebook('n.ipynb', 'Hello', 'Run the cell below.')
+        bt = FakeBingTranslator()
+        manifest = Manifest(os.path.join(self.tmpdir, 'manifest.json'))
+        translate_files(bt, [fname], to_lang=['ja', 'fr'], manifest=manifest, allow_update=True)
+        self.assertEqual(sorted(bt.to_langs), ['fr', 'ja'])
+        self.assertEqual(bt.requests, [['<p>Hello</p>', '<p>Run the cell below.</p>']] * 2)
+        for lang in ['ja', 'fr']:
+            with open(os.path.join(self.tmpdir, 'n_%s.ipynb' % lang)) as f:
+                doc = json.load(f)
+            self.assertEqual(''.join(doc['cells'][1]['source']), '_unchecked_\n\nKonnichiwa')
+        bt.requests = []
+        translate_files(bt, [fname], to_lang=['ja', 'fr'], manifest=manifest, allow_update=True)
+        self.assertEqual(bt.requests, [])
+        bt.to_langs = []
+        translate_files(bt, [fname], to_lang=['ja', 'de'], manifest=manifest, allow_update=True)
+        self.assertEqual(sorted(bt.to_langs), ['de', 'ja'])
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'n_de.ipynb')))
+
+    def test_translate_array_pipeline(self):
+        bt = FakeBingTranslator()
+        mt = MarkdownTranslator(bt)
+        text_list = ['Hello %d' % (i % 5) for i in range(20)]
+        expected = mt.translate_array(list(text_list), from_lang='en', to_lang='ja')
+        self.assertEqual(len(bt.requests), 1)
+        bt.requests = []
+        mt.pipeline_chunk_chars = 1
+        mt.pipeline_depth = 2
+        self.assertEqual(mt.translate_array(list(text_list), from_lang='en', to_lang='ja'), expected)
+        self.assertEqual(bt.requests, [['<p>Hello %d</p>' % i] for i in range(5)])
+
+    def test_translate_array_pipeline_interrupt(self):
+        import time
+
+        class Backend(TranslatorBackend):
+            max_chars_per_request = 40
+
+            def translate_array(self, text_list, **config):
+                time.sleep(0.01)
+                requests.append(list(text_list))
+                return list(text_list)
+
+        requests = []
+        bt = Backend(cache_fname=os.path.join(self.tmpdir, 'cache.sqlite'), legacy_cache_fname=None, max_concurrency=1)
+        mt = MarkdownTranslator(bt)
+        mt.pipeline_chunk_chars = 200
+        mt.pipeline_depth = 4
+
+        def finish(html, prepared):
+            sent.append(len(requests))
+            raise KeyboardInterrupt()
+
+        sent = []
+        mt.finish = finish
+        with self.assertRaises(KeyboardInterrupt):
+            mt.translate_array(['Text %d' % i for i in range(200)], from_lang='en', to_lang='ja')
+        # The running chunks stop after their current batches instead of
+        # sending all of theirs.
+        self.assertLessEqual(len(requests) - sent[0], mt.pipeline_depth)
+        bt.cache.close()
+
+    def test_conversion_pool(self):
+        text_list = [
+            'Hello *world* %d' % i if i % 3 else '- Hello $x_%d$\n- `code` and [link](http://example.com/%d)' % (i, i)
+            for i in range(50)
+            ]
+        expected = MarkdownTranslator(FakeBingTranslator()).translate_array(list(text_list), from_lang='en', to_lang='ja')
+        pool = make_conversion_pool(2)
+        try:
+            mt = MarkdownTranslator(FakeBingTranslator(), pool=pool)
+            mt.pool_chunk_size = 7
+            mt.pipeline_chunk_chars = 200
+            self.assertEqual(mt.translate_array(list(text_list), from_lang='en', to_lang='ja'), expected)
+            res = mt.translate_array_multi({'ja': text_list, 'fr': text_list[:10]}, from_lang='en')
+            self.assertEqual(res, {'ja': expected, 'fr': expected[:10]})
+        finally:
+            pool.shutdown()
+
+    def test_notebook_stream(self):
+        import io
+        doc = make_notebook('Hello', 'Hello \\"world\\"\n')
+        doc['cells'].insert(1, {
+            'cell_type': 'code', 'execution_count': 1, 'metadata': {},
+            'outputs': [{'data': {'image/png': 'iVBOR\\w0KG' * 100}, 'output_type': 'display_data'}],
+            'source': ['print("[{\\"}]")']
+            })
+        text = json.dumps(doc, indent=1, ensure_ascii=False, sort_keys=True)
+        for chunk_size in [1, 7, 1 << 16]:
+            out = io.StringIO()
+            NotebookStream(io.StringIO(text), chunk_size=chunk_size).copy(out.write, lambda cell: [cell])
+            self.assertEqual(out.getvalue(), text)
+            cells = list(NotebookStream(io.StringIO(text), chunk_size=chunk_size).iter_markdown_cells())
+            self.assertEqual(cells, [doc['cells'][0], doc['cells'][2]])
+
+        fname = self.write_notebook('n.ipynb')
+        with open(fname, 'w') as f:
+            f.write(text)
+        outfname = os.path.join(self.tmpdir, 'n_ja.ipynb')
+        translate_files(FakeBingTranslator(), [fname], to_lang='ja')
+        expected = self.read_file(outfname)
+        translate_files(FakeBingTranslator(), [fname], to_lang='ja', stream=True, allow_overwrite=True)
+        self.assertEqual(self.read_file(outfname), expected)
+
+    def test_skip_untranslatable(self):
+        self.assertFalse(needs_translation('![plot](plot.png)\n\n$$y = ax + b$$'))
+        self.assertFalse(needs_translation(u'\u3053\u308c\u306f\u65e5\u672c\u8a9e\u3067\u3059', 'en', 'ja'))
+        self.assertTrue(needs_translation(u'\u3053\u308c\u306f\u65e5\u672c\u8a9e\u3067\u3059', 'ja', 'zh-Hans'))
+        self.assertTrue(needs_translation('Fit a line to $x$.'))
+
+        fname = self.write_notebook('n.ipynb', 'Hello', '```\nprint(1)\n```')
+        bt = FakeBingTranslator()
+        translate_files(bt, [fname], to_lang='ja', replace=True)
+        self.assertEqual(bt.requests, [['<p>Hello</p>']])
+        with open(os.path.join(self.tmpdir, 'n_ja.ipynb')) as f:
+            doc = json.load(f)
+        self.assertEqual(doc['cells'][1]['source'], '```\nprint(1)\n```')
+
+    def test_skip_untranslatable_update(self):
+        # Reviewed translations of cells which are skipped are kept.
+        fname = self.write_notebook('n.ipynb', 'Hello', '[Previous](a.ipynb) | [Next](b.ipynb)')
+        outfname = os.path.join(self.tmpdir, 'n_ja.ipynb')
+        translate_files(FakeBingTranslator(), [fname], to_lang='ja', replace=True)
+        with open(outfname) as f:
+            doc = json.load(f)
+        doc['cells'][1]['source'] = u'[\u524d\u3078](a.ipynb) | [\u6b21\u3078](b.ipynb)'
+        doc['cells'][1]['metadata']['original_source'] = '[Previous](a.ipynb) | [Next](b.ipynb)'
+        with open(outfname, 'w') as f:
+            json.dump(doc, f)
+
+        translate_files(FakeBingTranslator(), [fname], to_lang='ja', allow_update=True, replace=True)
+        with open(outfname) as f:
+            doc = json.load(f)
+        self.assertEqual(''.join(doc['cells'][1]['source']), u'[\u524d\u3078](a.ipynb) | [\u6b21\u3078](b.ipynb)')
+        self.assertEqual(''.join(doc['cells'][1]['metadata']['original_source']), '[Previous](a.ipynb) | [Next](b.ipynb)')
+
+    def test_manifest(self):
+        os.mkdir(os.path.join(self.tmpdir, 'sub'))
+        fnames = [self.write_notebook('a.ipynb', 'Hello a'), self.write_notebook(os.path.join('sub', 'b.ipynb'), 'Hello b')]
+        outdir = os.path.join(self.tmpdir, 'out')
+        os.mkdir(outdir)
+        manifest_fname = os.path.join(outdir, 'manifest.json')
+        config = dict(to_lang='ja', allow_update=True, output_dir=outdir, input_root=self.tmpdir)
+        bt = FakeBingTranslator()
+        translate_files(bt, fnames, manifest=Manifest(manifest_fname), **config)
+        self.assertEqual(len(bt.requests), 2)
+        self.assertTrue(os.path.exists(os.path.join(outdir, 'sub', 'b_ja.ipynb')))
+
+        bt = FakeBingTranslator()
+        stats = translate_files(bt, fnames, manifest=Manifest(manifest_fname), **config)
+        self.assertEqual(stats.children, [])
+
+        self.write_notebook('a.ipynb', 'Hello again')
+        stats = translate_files(bt, fnames, manifest=Manifest(manifest_fname), **config)
+        self.assertEqual([child.name for child in stats.children], [fnames[0]])
+        stats = translate_files(bt, fnames, manifest=Manifest(manifest_fname), **dict(config, replace=True))
+        self.assertEqual(len(stats.children), 2)
+
+        # Entries are written in batches and flushed at the end.
+        manifest = Manifest(os.path.join(self.tmpdir, 'manifest2.json'))
+        manifest.record(fnames[0], manifest.file_state(fnames[0]), [], 'options')
+        manifest.save()
+        self.assertFalse(os.path.exists(manifest.fname))
+        manifest.flush()
+        self.assertTrue(Manifest(manifest.fname).is_current(fnames[0], [], 'options'))
+
+    def test_update_segments(self):
+        fname = self.write_notebook('n.ipynb', 'Hello one\n\nHello two\n\nHello three')
+        outfname = os.path.join(self.tmpdir, 'n_ja.ipynb')
+        translate_files(FakeBingTranslator(), [fname], to_lang='ja', replace=True)
+        with open(outfname) as f:
+            doc = json.load(f)
+        doc['cells'][0]['source'] = 'Konnichiwa one\n\nReviewed two\n\nKonnichiwa three'
+        with open(outfname, 'w') as f:
+            json.dump(doc, f)
+        self.write_notebook('n.ipynb', 'Hello one\n\nHello two\n\nHello three!')
+
+        bt = FakeBingTranslator()
+        translate_files(bt, [fname], to_lang='ja', allow_update=True, replace=True)
+        self.assertEqual(bt.requests, [['<p>Hello three!</p>']])
+        with open(outfname) as f:
+            doc = json.load(f)
+        self.assertEqual(
+            ''.join(doc['cells'][0]['source']),
+            '_unchecked_\n\nKonnichiwa one\n\nReviewed two\n\nKonnichiwa three!')
+
+    def test_translate_array_safe_order(self):
+        import random
+        import time
+
+        class SlowBingTranslator(BingTranslator):
+            def translate_array(self, text_list, **config):
+                time.sleep(random.random() * 0.01)
+                return [text.upper() for text in text_list]
+
+        bt = SlowBingTranslator(None, cache_fname=os.path.join(self.tmpdir, 'bing.cache.sqlite'), max_concurrency=8)
+        text_list = ['text %d ' % i * 200 for i in range(100)]
+        self.assertEqual(bt.translate_array_safe(text_list), [text.upper() for text in text_list])
+
+    def test_mock_server(self):
+        translate_func = lambda text, to_lang: text.replace('Hello', 'Konnichiwa')
+        with MockTranslatorServer(translate_func=translate_func) as server:
+            bt = BingTranslator(
+                'mock', cache_fname=os.path.join(self.tmpdir, 'bing.cache.sqlite'),
+                legacy_cache_fname=None, endpoint=server.url)
+            mt = MarkdownTranslator(bt)
+            res = mt.translate_array(['Hello *world*', '- Hello $x$'], from_lang='en', to_lang='ja')
+            self.assertEqual(res, ['Konnichiwa *world*', '- Konnichiwa $x$'])
+            self.assertEqual(mt.translate('Hello', from_lang='en', to_lang='ja'), 'Konnichiwa')
+            self.assertEqual(server.requests, 2)
+            bt.cache.close()
+
+    def test_request_timeout(self):
+        with MockTranslatorServer(latency=0.5) as server:
+            bt = BingTranslator(
+                'mock', cache_fname=os.path.join(self.tmpdir, 'bing.cache.sqlite'),
+                legacy_cache_fname=None, endpoint=server.url, timeout=(1.0, 0.05))
+            with self.assertRaises(TransientError):
+                bt.translate_array(['<p>Text</p>'], from_lang='en', to_lang='ja')
+            bt.cache.close()
+
+    def test_retry_with_backoff(self):
+        with MockTranslatorServer(error_rate=0.3) as server:
+            bt = BingTranslator(
+                'mock', cache_fname=os.path.join(self.tmpdir, 'bing.cache.sqlite'),
+                legacy_cache_fname=None, endpoint=server.url)
+            bt.scheduler.base_delay = 0.001
+            bt.scheduler.max_chars = bt.scheduler.chars = 100
+            text_list = ['<p>Text %d</p>' % i for i in range(100)]
+            stats = Stats()
+            with stats.activate():
+                res = bt.translate_array_safe(text_list, from_lang='en', to_lang='ja')
+            self.assertEqual(res, text_list)
+            self.assertGreater(stats.counts['retries'], 0)
+            bt.cache.close()
+
+    def test_request_scheduler(self):
+        scheduler = RequestScheduler(max_concurrency=8, max_chars=10240, base_delay=0.001)
+        failures = [TransientError('429', retry_after=0.01, throttled=True)] * 2
+
+        def request():
+            if len(failures) > 0:
+                raise failures.pop()
+            return 'ok'
+
+        self.assertEqual(scheduler.call(request), 'ok')
+        self.assertLess(scheduler.concurrency, 3)
+        self.assertLess(scheduler.chars, 10240 // 2)
+        failures.append(TransientError('500'))
+        scheduler.max_retries = 0
+        self.assertRaises(TransientError, scheduler.call, request)
+
+    def test_shard_files(self):
+        fnames = [self.write_notebook('n%d.ipynb' % i, 'Hello ' * (i * 10)) for i in range(10)]
+        for by in ['size', 'hash']:
+            shards = [shard_files(fnames, i, 3, by) for i in range(3)]
+            self.assertEqual(sorted(sum(shards, [])), sorted(fnames))
+            self.assertEqual(shards, [shard_files(list(reversed(fnames)), i, 3, by)[::-1] for i in range(3)])
+        loads = [sum(os.path.getsize(fname) for fname in shard_files(fnames, i, 3)) for i in range(3)]
+        self.assertLess(max(loads) - min(loads), max(os.path.getsize(fname) for fname in fnames))
+
+    def test_cache_shards(self):
+        shard_fnames = [os.path.join(self.tmpdir, 'shard%d.sqlite' % i) for i in range(2)]
+        for i, fname in enumerate(shard_fnames):
+            cache = TranslationCache(fname)
+            cache.put_many([('k%d' % i, 'v%d' % i), ('common', 'shard%d' % i)])
+            cache.close()
+        cache = TranslationCache(os.path.join(self.tmpdir, 'cache.sqlite'), shard_fnames)
+        self.assertEqual([cache.get(key) for key in ['k0', 'k1', 'common', 'k2']], ['v0', 'v1', 'shard0', None])
+        self.assertEqual(len(cache), 0)
+        cache.close()
+        cache = TranslationCache(os.path.join(self.tmpdir, 'merged.sqlite'))
+        for fname in shard_fnames:
+            self.assertEqual(cache.merge(fname), 2)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual([cache.get(key) for key in ['k0', 'k1']], ['v0', 'v1'])
+        self.assertIn(cache.get('common'), ['shard0', 'shard1'])
+        cache.close()
+
+    def test_batch_planner(self):
+        class Backend(TranslatorBackend):
+            max_chars_per_request = 100
+
+            def translate_array(self, text_list, **config):
+                batches.append(list(text_list))
+                return [text.upper() for text in text_list]
+
+        batches = []
+        bt = Backend(cache_fname=os.path.join(self.tmpdir, 'cache.sqlite'), legacy_cache_fname=None, max_concurrency=1)
+        text_list = ['a' * 60, 'b' * 50, 'c' * 40, 'd' * 30, 'e' * 20]
+        self.assertEqual(bt.translate_array_safe(text_list, to_lang='ja'), [text.upper() for text in text_list])
+        self.assertEqual(batches, [['a' * 60, 'c' * 40], ['b' * 50, 'd' * 30, 'e' * 20]])
+
+        batches = []
+        sentence = 'This is a sentence of forty characters. '
+        text = sentence * 6 + '\n\n' + 'x' * 150
+        self.assertEqual(bt.translate_array_safe([text], to_lang='ja'), [text.upper()])
+        self.assertTrue(all(sum(len(part) for part in batch) <= 100 for batch in batches))
+        self.assertEqual(sorted(part for batch in batches for part in batch), sorted(set(bt.split_text(text, 100)[1::2])))
+        self.assertEqual(bt.split_text(text, 100)[:5], ['', (sentence * 2).strip(), ' ', (sentence * 2).strip(), ' '])
+        batches = []
+        self.assertEqual(bt.translate_array_safe([text], to_lang='ja'), [text.upper()])
+        self.assertEqual(batches, [])
+
+        # HTML is split into balanced parts, and the whitespace between them
+        # is kept even if the service trims it.
+        def translate_array(text_list, **config):
+            batches.append(list(text_list))
+            return [text.upper().strip() for text in text_list]
+
+        batches = []
+        bt.translate_array = translate_array
+        html = '<h1>Title</h1>\n<p>%s<em>%s</em> end.</p>' % (sentence * 4, sentence)
+        self.assertEqual(
+            bt.translate_array_safe([html], to_lang='ja', content_type='text/html'),
+            ['<H1>TITLE</H1>\n<p>%s<EM>%s</EM> END.</p>' % ((sentence * 4).upper(), sentence.upper())])
+        parts = [part for batch in batches for part in batch]
+        self.assertIn('<h1>Title</h1>', parts)
+        self.assertIn('<em>%s</em> end.' % (sentence,), parts)
+        self.assertTrue(all(part.count('<') == part.count('</') * 2 for part in parts))
+        bt.cache.close()
+
+        bt = BingTranslator(None, cache_fname=os.path.join(self.tmpdir, 'bing.cache.sqlite'), legacy_cache_fname=None)
+        self.assertEqual(bt.text_size('<p>a</p>'), len('&lt;p&gt;a&lt;/p&gt;<ns1:string></ns1:string>'))
+        bt.cache.close()
+
+    def test_translation_cache(self):
+        legacy_fname = os.path.join(self.tmpdir, 'bing.cache')
+        params = urllib.parse.urlencode({'text': 'Hello!', 'contentType': 'text/html', 'from': 'en', 'to': 'ja'})
+        with open(legacy_fname, 'w') as f:
+            json.dump({params: 'Konnichiwa!'}, f)
+        cache_fname = os.path.join(self.tmpdir, 'bing.cache.sqlite')
+        bt = BingTranslator(None, cache_fname=cache_fname, legacy_cache_fname=legacy_fname)
+        self.assertEqual(bt.translate('Hello!'), 'Konnichiwa!')
+        self.assertEqual(len(bt.cache), 1)
+        bt.load_cache()
+        self.assertEqual(len(bt.cache), 1)
+
+        bt.translate_array = lambda text_list, **config: [text.upper() for text in text_list]
+        self.assertEqual(bt.translate_array_safe(['a', 'b', 'a'], from_lang='en', to_lang='ja'), ['A', 'B', 'A'])
+        bt.translate_array = None
+        bt.cache.close()
+        bt = BingTranslator(None, cache_fname=cache_fname, legacy_cache_fname=None)
+        self.assertEqual(bt.translate_array_safe(['b', 'a'], from_lang='en', to_lang='ja'), ['B', 'A'])
+        bt.cache.evict(max_entries=0)
+        self.assertEqual(len(bt.cache), 0)
+        bt.cache.close()
+
+    def test_translate_file_markdown(self):
+        fname = os.path.join(self.tmpdir, 'doc.md')
+        with open(fname, 'w') as f:
+            f.write('# Hello\n\nHello *world*.\n\n```\nprint(1)\n```\n\n- Hello\n- Hello again\n\nHello *world*.\n')
+        bt = FakeBingTranslator()
+        translate_files(bt, [fname], from_lang='en', to_lang='ja', allow_update=False, allow_overwrite=False, replace=True)
+        self.assertEqual(
+            self.read_file(os.path.join(self.tmpdir, 'doc_ja.md')).decode('utf-8'),
+            '# Konnichiwa\n\nKonnichiwa *world*.\n\n```\nprint(1)\n```\n\n- Konnichiwa\n- Konnichiwa again\n\nKonnichiwa *world*.\n')
+        self.assertEqual(len(bt.requests), 1)
+        self.assertEqual(len(bt.requests[0]), 3)
+
+        with self.assertRaises(Exception):
+            translate_files(bt, [fname], from_lang='en', to_lang='ja', allow_update=True, replace=True)
+
+        nt = NotebookTranslator(bt)
+        nt.markdown_chunk_chars = 20
+        bt.requests = []
+        nt.translate_file(fname, allow_overwrite=True, from_lang='en', to_lang='ja')
+        self.assertEqual([len(request) for request in bt.requests], [2, 1, 1])
+
+    def test_translate_file_markdown_references(self):
+        fname = os.path.join(self.tmpdir, 'doc.md')
+        with open(fname, 'w') as f:
+            f.write('Hello, see the [guide][Guide].\n\n[guide]: http://example.com/guide "The Guide"\n[home]: http://example.com/\n\nHello [home].\n')
+        bt = FakeBingTranslator()
+        translate_files(bt, [fname], from_lang='en', to_lang='ja', replace=True)
+        self.assertEqual(
+            self.read_file(os.path.join(self.tmpdir, 'doc_ja.md')).decode('utf-8'),
+            'Konnichiwa, see the [guide](http://example.com/guide "The Guide").\n\n'
+            '[guide]: http://example.com/guide "The Guide"\n[home]: http://example.com/\n\n'
+            'Konnichiwa [home](http://example.com/).\n')
+        self.assertEqual(MarkdownTranslator(None).unmarkdown(''), '')
+
+    def test_resume(self):
+        fnames = [self.write_notebook('n%d.ipynb' % i, 'Hello %d' % i) for i in range(3)]
+        manifest_fname = os.path.join(self.tmpdir, 'manifest.json')
+        bt = FakeBingTranslator()
+        translate_array_safe = bt.translate_array_safe
+
+        def interrupt(text_list, **config):
+            if '<p>Hello 1</p>' in text_list:
+                raise KeyboardInterrupt()
+            return translate_array_safe(text_list, **config)
+
+        bt.translate_array_safe = interrupt
+        with self.assertRaises(KeyboardInterrupt):
+            translate_files(bt, fnames, manifest=Manifest(manifest_fname), to_lang='ja')
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'n0_ja.ipynb')))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'n1_ja.ipynb')))
+        self.assertEqual([fname for fname in os.listdir(self.tmpdir) if fname.endswith('.tmp')], [])
+
+        bt = FakeBingTranslator()
+        translate_files(bt, fnames, manifest=Manifest(manifest_fname), to_lang='ja')
+        self.assertEqual(bt.requests, [['<p>Hello 1</p>'], ['<p>Hello 2</p>']])
+
+    def test_resume_plain_run(self):
+        # A directory run started without --resume records its progress too.
+        fnames = [self.write_notebook('n%d.ipynb' % i, 'Hello %d' % i) for i in range(3)]
+        manifest_fname = os.path.join(self.tmpdir, 'manifest.json')
+        bt = FakeBingTranslator()
+        translate_array_safe = bt.translate_array_safe
+
+        def interrupt(text_list, **config):
+            if '<p>Hello 1</p>' in text_list:
+                raise KeyboardInterrupt()
+            return translate_array_safe(text_list, **config)
+
+        bt.translate_array_safe = interrupt
+        with self.assertRaises(KeyboardInterrupt):
+            translate_files(bt, fnames, manifest=Manifest(manifest_fname), skip_unchanged=False, to_lang='ja')
+        with self.assertRaises(Exception):
+            translate_files(FakeBingTranslator(), fnames, manifest=Manifest(manifest_fname), skip_unchanged=False, to_lang='ja')
+
+        bt = FakeBingTranslator()
+        translate_files(bt, fnames, manifest=Manifest(manifest_fname), to_lang='ja')
+        self.assertEqual(bt.requests, [['<p>Hello 1</p>'], ['<p>Hello 2</p>']])
+
+    def test_atomic_open(self):
+        fname = os.path.join(self.tmpdir, 'out.txt')
+        with atomic_open(fname) as f:
+            f.write('old')
+        with self.assertRaises(RuntimeError):
+            with atomic_open(fname) as f:
+                f.write('new')
+                raise RuntimeError()
+        self.assertEqual(self.read_file(fname), b'old')
+        self.assertEqual(os.listdir(self.tmpdir), ['out.txt'])
+
+    def test_daemon(self):
+        import urllib.request
+        fnames = [self.write_notebook('n%d.ipynb' % i, 'Hello %d' % i) for i in range(2)]
+        with MockTranslatorServer() as mock:
+            bt = BingTranslator(
+                'mock', cache_fname=os.path.join(self.tmpdir, 'bing.cache.sqlite'),
+                legacy_cache_fname=None, endpoint=mock.url)
+            daemon = TranslationDaemon(bt, self.tmpdir, Manifest(os.path.join(self.tmpdir, 'manifest.json')), from_lang='en', to_lang='ja')
+            self.assertEqual(daemon.poll(), fnames)
+            daemon.translate()
+            self.assertEqual(mock.requests, 2)
+            self.assertEqual(daemon.poll(), [])
+
+            self.write_notebook('n1.ipynb', 'Hello 1', 'Hello again')
+            self.assertEqual(daemon.poll(), [fnames[1]])
+            daemon.translate([fnames[1]])
+            self.assertEqual(mock.requests, 3)
+            self.assertEqual(mock.chars, len('<p>Hello 0</p><p>Hello 1</p><p>Hello again</p>'))
+
+            server = daemon.serve(0)
+            url = 'http://127.0.0.1:%d/' % (server.server_address[1],)
+            try:
+                with urllib.request.urlopen(url + 'translate', json.dumps({'paths': ['n0.ipynb']}).encode('utf-8')) as f:
+                    self.assertIn('counts', json.loads(f.read().decode('utf-8')))
+                # The request thread reused the notebook translator.
+                self.assertEqual(daemon._translators.qsize(), 1)
+                with urllib.request.urlopen(url + 'status') as f:
+                    self.assertEqual(json.loads(f.read().decode('utf-8')), {'notebooks': 2, 'cache': 3})
+                with self.assertRaises(urllib.error.HTTPError) as cm:
+                    urllib.request.urlopen(url + 'translate', json.dumps({'paths': ['../n0.ipynb']}).encode('utf-8'))
+                self.assertEqual(cm.exception.code, 400)
+                self.assertEqual(mock.requests, 3)
+            finally:
+                server.shutdown()
+                server.server_close()
+                bt.cache.close()
+
+    def test_offline(self):
+        fnames = [self.write_notebook('n%d.ipynb' % i, 'Hello %d' % i) for i in range(2)]
+        cache_fname = os.path.join(self.tmpdir, 'bing.cache.sqlite')
+        with MockTranslatorServer() as server:
+            bt = BingTranslator('mock', cache_fname=cache_fname, legacy_cache_fname=None, endpoint=server.url)
+            translate_files(bt, fnames, from_lang='en', to_lang='ja', replace=True)
+            bt.cache.close()
+        self.write_notebook('n1.ipynb', 'Hello 1', 'Goodbye')
+        bt = BingTranslator(None, cache_fname=cache_fname, legacy_cache_fname=None, endpoint='http://127.0.0.1:9')
+        bt.offline = True
+        for corpus in [False, True]:
+            stats = translate_files(bt, fnames, corpus=corpus, from_lang='en', to_lang='ja', replace=True, allow_overwrite=True)
+            self.assertEqual(stats.counts['missing cells'], 1)
+            self.assertNotIn('requests', stats.counts)
+            self.assertIn('Hello 1', self.read_file(os.path.join(self.tmpdir, 'n1_ja.ipynb')).decode('utf-8'))
+            self.assertNotIn('Goodbye', self.read_file(os.path.join(self.tmpdir, 'n1_ja.ipynb')).decode('utf-8'))
+        bt.cache.close()
+
+    def test_lazy_imports(self):
+        import subprocess
+        import sys
+        code = "import sys, jupyter_translate; print(sorted(m for m in ('requests', 'lxml', 'markdown') if m in sys.modules))"
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.decode('utf-8').strip(), '[]')
+
+    def test_translation_memory(self):
+        memory = TranslationMemory(os.path.join(self.tmpdir, 'memory.sqlite'))
+        source = 'Call `train_model` with the training data and print the accuracy of the model on the test set.'
+        memory.add_many([(source, 'Reviewed'), ('Unrelated text about plotting.', 'Other')], 'en', 'ja')
+        changed = source.replace('train_model', 'fit_model')
+        self.assertEqual(memory.lookup(source, 'en', 'ja'), (1.0, source, 'Reviewed'))
+        similarity, match, target = memory.lookup(changed, 'en', 'ja')
+        self.assertEqual((match, target), (source, 'Reviewed'))
+        self.assertTrue(0.8 <= similarity < 1.0)
+        self.assertIsNone(memory.lookup(changed, 'en', 'fr'))
+        self.assertIsNone(memory.lookup('Something else entirely.', 'en', 'ja'))
+
+        fname = self.write_notebook('n.ipynb', source, changed)
+        bt = FakeBingTranslator()
+        translate_files(bt, [fname], memory=memory, to_lang='ja')
+        self.assertEqual(len(bt.requests), 1)
+        self.assertEqual(len(bt.requests[0]), 1)
+        with open(os.path.join(self.tmpdir, 'n_ja.ipynb')) as f:
+            doc = json.load(f)
+        self.assertEqual(doc['cells'][1]['source'], ['Reviewed'])
+        self.assertEqual(doc['cells'][3]['metadata']['translation_memory']['translation'], 'Reviewed')
+
+        memory.reuse = True
+        bt = FakeBingTranslator()
+        translate_files(bt, [fname], memory=memory, to_lang='ja', allow_overwrite=True)
+        self.assertEqual(bt.requests, [])
+        with open(os.path.join(self.tmpdir, 'n_ja.ipynb')) as f:
+            doc = json.load(f)
+        self.assertEqual(doc['cells'][3]['source'], ['_unchecked_\n', '\n', 'Reviewed'])
+        memory.close()
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file